@@ -12,16 +12,39 @@ ANSIBLE_METADATA = {
     'supported_by': 'yavdr'
 }
 
+import functools
 import gettext
 from ansible.errors import AnsibleFilterError
 from ansible.utils import helpers
 from ansible.module_utils._text import to_text
 
 
-def translate_yavdr(text):
-    gettext.textdomain('yavdr')
+class Translator(object):
+    ''' loads the catalog of a text domain once per locale and caches the lookups '''
+
+    def __init__(self, domain='yavdr', localedir=None, maxsize=1024):
+        self.domain = domain
+        self.localedir = localedir
+        self.catalogs = {}
+        self.lookup = functools.lru_cache(maxsize=maxsize)(self._lookup)
+
+    def catalog(self, lang=None):
+        # lang=None selects the locale from LANGUAGE, LC_ALL, LC_MESSAGES and LANG like gettext.gettext()
+        if lang not in self.catalogs:
+            self.catalogs[lang] = gettext.translation(
+                self.domain, self.localedir, languages=[lang] if lang else None, fallback=True)
+        return self.catalogs[lang]
+
+    def _lookup(self, text, lang=None):
+        return to_text(self.catalog(lang).gettext(text))
+
+
+translator = Translator()
+
+
+def translate_yavdr(text, lang=None):
     try:
-        return to_text(gettext.gettext(text))
+        return translator.lookup(text, lang)
     except:
         return to_text(text)
 
@@ -43,8 +43,37 @@ DOCUMENTATION = '''
         default: True
         description:
           - return a list of supported acpi power saving modes
+
+    autoinstall_rules:
+        required: False
+        default: None
+        description:
+          - a dict of named rules, each rule lists the ids in its 'pci' and 'usb' keys and
+            the kernel module names in its 'modules' key which trigger it
+          - ids are written as 'vendor:device', 'vendor:*' matches every device of a vendor,
+            pci ids may be extended by the subsystem ids as 'vendor:device:subvendor:subdevice'
+            or 'vendor:device:subvendor:*'
+          - all other keys of a rule (e.g. 'description', 'firmware', 'packages') are
+            returned for matching rules
+          - the result is returned as autoinstall_matches, a dict with the names of the
+            matching rules as keys
+
+    cache:
+        required: False
+        default: 'off'
+        choices: [ 'refresh', 'use', 'off' ]
+        description:
+          - use - return the cached facts if the hardware fingerprint did not change, rescan otherwise
+          - refresh - always rescan and update the cache
+          - off - neither read nor write the cache
+
+    cache_dir:
+        required: False
+        default: /etc/ansible/facts.d
+        description:
+          - directory for the cache file (hardware_facts.cache)
 notes:
-   - requires python3-pyusb and python3-kmodpy
+   - reads /sys/bus/pci/devices, /sys/bus/usb/devices and /proc/modules directly
 requirements: [ ]
 author: "Alexander Grothe <seahawk1986@gmx.de>"
 '''
@@ -57,6 +86,15 @@ EXAMPLES = '''
     serial: True
     modules: True
     acpi_power_modes: True
+    autoinstall_rules:
+      targavfd:
+        usb: [ '19c2:6a11' ]
+        packages: [ vdr-plugin-targavfd ]
+      dvbsky-firmware:
+        pci: [ '1ade:3038' ]
+      dvbsddevice:
+        modules: [ dvb_ttpci ]
+    cache: use
 - debug:
     var: usb
 - debug:
@@ -69,21 +107,22 @@ EXAMPLES = '''
     var: gpus
 - debug:
     var: acpi_power_modes
+- debug:
+    var: autoinstall_matches
 '''
 
 import glob
-import json
 import os
 import sys
-import usb.core
 from collections import namedtuple
-from itertools import chain
 
-import kmodpy
 from ansible.module_utils.basic import *
+from ansible.module_utils.hardware_cache import hardware_fingerprint, load_cache, read_module_names, store_cache
 
 
-PCIDevice = namedtuple("PCIDevice", 'idVendor idProduct idClass pciPath')
+PCIDevice = namedtuple("PCIDevice", 'idVendor idProduct idClass idSubVendor idSubProduct slot driver pciPath')
+USBDevice = namedtuple("USBDevice", 'idVendor idProduct usbPath')
+HardwareIndex = namedtuple("HardwareIndex", 'pci usb modules')
 
 vendor_dict = {
     0x10de: 'nvidia',
@@ -92,18 +131,67 @@ vendor_dict = {
     0x80ee: 'virtualbox',
     }
 
-def get_pci_devices():
-    for device in chain(glob.glob('/sys/devices/pci*/*:*:*/'), glob.glob('/sys/devices/pci*/*:*:*/*:*:*/')):
+def read_uevent(path):
+    """
+    parse the KEY=VALUE lines of a sysfs uevent file into a dict
+    """
+    data = {}
+    with open(os.path.join(path, 'uevent')) as f:
+        for line in f:
+            key, _, value = line.rstrip('\n').partition('=')
+            data[key] = value
+    return data
+
+def get_pci_devices(sysfs='/sys'):
+    """
+    /sys/bus/pci/devices links every pci function regardless of the
+    bridge depth, the uevent file holds all ids we need in a single read
+    """
+    base = os.path.join(sysfs, 'bus', 'pci', 'devices')
+    try:
+        entries = sorted(os.listdir(base))
+    except OSError:
+        return
+    for entry in entries:
+        path = os.path.realpath(os.path.join(base, entry))
+        try:
+            uevent = read_uevent(path)
+            vendor_id, product_id = (int(i, 16) for i in uevent['PCI_ID'].split(':'))
+            sub_vendor_id, sub_product_id = (int(i, 16) for i in uevent.get('PCI_SUBSYS_ID', '0:0').split(':'))
+            class_id = int(uevent['PCI_CLASS'], 16)
+        except (IOError, KeyError, ValueError):
+            continue
+        yield PCIDevice(idVendor=vendor_id, idProduct=product_id, idClass=class_id,
+                        idSubVendor=sub_vendor_id, idSubProduct=sub_product_id,
+                        slot=uevent.get('PCI_SLOT_NAME', entry), driver=uevent.get('DRIVER'),
+                        pciPath=path)
+
+def get_usb_devices(sysfs='/sys'):
+    """
+    only usb devices (not their interfaces) provide an idVendor file
+    """
+    for id_vendor in sorted(glob.glob(os.path.join(sysfs, 'bus', 'usb', 'devices', '*', 'idVendor'))):
+        path = os.path.dirname(id_vendor)
         try:
-            with open(os.path.join(device, 'device')) as d:
-                product_id = int(d.read().strip(), 16)
-            with open(os.path.join(device, 'vendor')) as d:
-                vendor_id = int(d.read().strip(), 16)
-            with open(os.path.join(device, 'class')) as d:
-                class_id = int(d.read().strip(), 16)
-            yield PCIDevice(idVendor=vendor_id, idProduct=product_id, idClass=class_id, pciPath=device)
-        except IOError:
-            pass
+            with open(id_vendor) as f:
+                vendor_id = int(f.read().strip(), 16)
+            with open(os.path.join(path, 'idProduct')) as f:
+                product_id = int(f.read().strip(), 16)
+        except (IOError, ValueError):
+            continue
+        yield USBDevice(idVendor=vendor_id, idProduct=product_id, usbPath=path)
+
+def get_loaded_modules(proc_modules='/proc/modules'):
+    return read_module_names(proc_modules)
+
+def scan_hardware(usb=True, pci=True, modules=True):
+    """
+    collect pci and usb devices and loaded kernel modules in a single pass,
+    all facts are derived from the returned index
+    """
+    return HardwareIndex(pci=list(get_pci_devices()) if pci else [],
+                         usb=list(get_usb_devices()) if usb else [],
+                         modules=get_loaded_modules() if modules else [])
 
 def format_device_list(iterator):
     return ["{:04x}:{:04x}".format(d.idVendor, d.idProduct) for d in iterator]
@@ -117,6 +205,78 @@ def format_gpu_device_list(iterator):
     return [entry for entry in get_entries(iterator)]
 
 
+def parse_hex_id(value, wildcard=False):
+    if wildcard and value == '*':
+        return None
+    return int(value, 16)
+
+def compile_rules(rules):
+    """
+    turn the rule table into a dict which maps the lookup keys of a device
+    to the names of the rules it triggers:
+      ('usb', vendor, device), ('usb', vendor, None),
+      ('pci', vendor, device), ('pci', vendor, None),
+      ('pci', vendor, device, subvendor, subdevice), ('pci', vendor, device, subvendor, None),
+      ('modules', name)
+    """
+    index = {}
+    for name, rule in rules.items():
+        if not isinstance(rule, dict):
+            raise ValueError("rule {} is not a dict".format(name))
+        for bus in ('pci', 'usb'):
+            for pattern in rule.get(bus) or []:
+                fields = str(pattern).lower().split(':')
+                try:
+                    if len(fields) == 2:
+                        key = (bus, parse_hex_id(fields[0]), parse_hex_id(fields[1], wildcard=True))
+                    elif len(fields) == 4 and bus == 'pci' and '*' not in fields[1:3]:
+                        key = (bus, parse_hex_id(fields[0]), parse_hex_id(fields[1]),
+                               parse_hex_id(fields[2]), parse_hex_id(fields[3], wildcard=True))
+                    else:
+                        raise ValueError
+                except ValueError:
+                    raise ValueError("invalid {} id '{}' in rule {}".format(bus, pattern, name))
+                index.setdefault(key, set()).add(name)
+        for module_name in rule.get('modules') or []:
+            index.setdefault(('modules', module_name), set()).add(name)
+    return index
+
+def lookup_keys(index):
+    """
+    yield the lookup keys and the formatted id for every device and module
+    """
+    for d in index.pci:
+        device_id = "{:04x}:{:04x}".format(d.idVendor, d.idProduct)
+        yield ('pci', d.idVendor, d.idProduct), device_id
+        yield ('pci', d.idVendor, None), device_id
+        subsystem_id = "{}:{:04x}:{:04x}".format(device_id, d.idSubVendor, d.idSubProduct)
+        yield ('pci', d.idVendor, d.idProduct, d.idSubVendor, d.idSubProduct), subsystem_id
+        yield ('pci', d.idVendor, d.idProduct, d.idSubVendor, None), subsystem_id
+    for d in index.usb:
+        device_id = "{:04x}:{:04x}".format(d.idVendor, d.idProduct)
+        yield ('usb', d.idVendor, d.idProduct), device_id
+        yield ('usb', d.idVendor, None), device_id
+    for module_name in index.modules:
+        yield ('modules', module_name), module_name
+
+def match_rules(rules, index):
+    """
+    match the compiled rules against the hardware index in a single pass,
+    return the matching rules together with the ids which triggered them
+    """
+    compiled = compile_rules(rules)
+    matches = {}
+    for key, matched_id in lookup_keys(index):
+        for name in compiled.get(key, ()):
+            matches.setdefault(name, set()).add(matched_id)
+    result = {}
+    for name, matched_ids in matches.items():
+        entry = {k: v for k, v in rules[name].items() if k not in ('pci', 'usb', 'modules')}
+        entry['matched'] = sorted(matched_ids)
+        result[name] = entry
+    return result
+
+
 def get_serial_data(name):
     """
     get the I/O and IRQ numbers for the serial port
@@ -155,6 +315,9 @@ arg_specs = {
     'gpus': dict(default=True, type='bool', required=False),
     'serial': dict(default=True, type='bool', required=False),
     'acpi_power_modes': dict(default=True, type='bool', required=False),
+    'autoinstall_rules': dict(default=None, type='dict', required=False),
+    'cache': dict(default='off', choices=['refresh', 'use', 'off'], required=False),
+    'cache_dir': dict(default='/etc/ansible/facts.d', type='path', required=False),
     }
 
 
@@ -166,6 +329,18 @@ def main():
     collect_gpus = module.params['gpus']
     collect_serial = module.params['serial']
     collect_acpi_power_modes = module.params['acpi_power_modes']
+    autoinstall_rules = module.params['autoinstall_rules']
+    cache_mode = module.params['cache']
+    cache_file = os.path.join(module.params['cache_dir'], 'hardware_facts.cache')
+    cache_params = {k: module.params[k] for k in ('usb', 'pci', 'modules', 'gpus', 'serial', 'acpi_power_modes',
+                                                    'autoinstall_rules')}
+
+    if cache_mode != 'off':
+        fingerprint = hardware_fingerprint()
+        if cache_mode == 'use':
+            data = load_cache(cache_file, fingerprint, cache_params)
+            if data is not None:
+                module.exit_json(changed=False, ansible_facts=data, msg=data, cached=True)
 
     usb_devices = []
     pci_devices = []
@@ -177,19 +352,24 @@ def main():
     virtualbox_detected = False
     serial_devices = []
     acpi_power_modes = []
+    autoinstall_matches = {}
+
+    match_autoinstall_rules = autoinstall_rules is not None
+    index = scan_hardware(usb=collect_usb or match_autoinstall_rules,
+                          pci=collect_pci or collect_gpus or match_autoinstall_rules,
+                          modules=collect_modules or match_autoinstall_rules)
 
     if collect_usb:
-        usb_devices = format_device_list(usb.core.find(find_all=True))
+        usb_devices = format_device_list(index.usb)
 
     if collect_pci:
-        pci_devices = format_device_list(get_pci_devices())
+        pci_devices = format_device_list(index.pci)
 
     if collect_modules:
-        k = kmodpy.Kmod()
-        modules = [m[0] for m in k.loaded()]
+        modules = index.modules
 
     if collect_gpus:
-        gpus = format_gpu_device_list(get_pci_devices())
+        gpus = format_gpu_device_list(index.pci)
         nvidia_detected = any((True for gpu in gpus if gpu['VendorName'] == 'nvidia'))
         intel_detected = any((True for gpu in gpus if gpu['VendorName'] == 'intel'))
         amd_detected = any((True for gpu in gpus if gpu['VendorName'] == 'amd'))
@@ -201,6 +381,12 @@ def main():
     if collect_acpi_power_modes:
         acpi_power_modes = list_acpi_power_modes()
 
+    if match_autoinstall_rules:
+        try:
+            autoinstall_matches = match_rules(autoinstall_rules, index)
+        except ValueError as e:
+            module.fail_json(msg="invalid autoinstall_rules: {}".format(e))
+
     data = {'usb': usb_devices,
             'pci': pci_devices,
             'modules': modules,
@@ -211,8 +397,14 @@ def main():
             'intel_detected': intel_detected,
             'amd_detected': amd_detected,
             'virtualbox_detected': virtualbox_detected,
+            'autoinstall_matches': autoinstall_matches,
     }
-    module.exit_json(changed=False, ansible_facts=data, msg=data)
+    if cache_mode != 'off' and not module.check_mode:
+        try:
+            store_cache(cache_file, fingerprint, cache_params, data)
+        except (IOError, OSError) as e:
+            module.warn("could not write cache file {}: {}".format(cache_file, e))
+    module.exit_json(changed=False, ansible_facts=data, msg=data, cached=False)
 
 
 if __name__ == '__main__':
@@ -1,33 +1,62 @@
 #!/usr/bin/env python3
-# This module parses the output of lspci for detailed information about available (sub) devices.
+# This module collects detailed information about available pci (sub) devices from sysfs or the output of lspci.
 DOCUMENTATION = '''
   ---
   module: pci_facts
-  short_description: parses lspci output for detailed (sub) devices data
+  short_description: collects detailed pci (sub) devices data from sysfs or lspci
   description:
-      - This module parses the output of lspci for detailed information about available (sub) devices.
-      - returns a list with a dict for each device
+      - This module collects detailed information about available pci (sub) devices.
+      - returns a list with a dict for each device in the same format as the output of lspci -nm
+
+options:
+    backend:
+        required: False
+        default: auto
+        choices: [ 'auto', 'sysfs', 'lspci' ]
+        description:
+          - sysfs - read the device data from /sys/bus/pci/devices
+          - lspci - parse the output of lspci -nm
+          - auto - use sysfs if available, fall back to lspci
+
+    cache:
+        required: False
+        default: 'off'
+        choices: [ 'refresh', 'use', 'off' ]
+        description:
+          - use - return the cached facts if the hardware fingerprint did not change, rescan otherwise
+          - refresh - always rescan and update the cache
+          - off - neither read nor write the cache
+
+    cache_dir:
+        required: False
+        default: /etc/ansible/facts.d
+        description:
+          - directory for the cache file (pci_facts.cache)
 
 notes:
-    - requires lspci (package pciutils)
+    - the lspci backend requires lspci (package pciutils)
 
 '''
 
 EXAMPLES = '''
 - name: get detailled pci device infos
   pci_facts:
+    cache: use
 
 - debug:
     var: pci_devices
 '''
 
 
-import argparse
+import glob
+import os
 import shlex
 import subprocess
-from collections import namedtuple
 
 from ansible.module_utils.basic import *
+from ansible.module_utils.hardware_cache import hardware_fingerprint, load_cache, store_cache
+
+PCI_SYSFS = '/sys/bus/pci/devices'
 
 def convert2hex(arg):
     arg = arg.strip('"')
@@ -36,34 +65,104 @@ def convert2hex(arg):
     else:
         return None
 
+def make_device(slot, device_class, vendor_id, device_id, sub_vendor_id=None, sub_device_id=None,
+                revision=None, progif=None, other=None):
+    return {'revision': revision, 'progif': progif, 'slot': slot, 'device_class': device_class,
+            'vendor_id': vendor_id, 'device_id': device_id, 'sub_vendor_id': sub_vendor_id,
+            'sub_device_id': sub_device_id, 'other': other or []}
+
+def parse_lspci_line(line):
+    """
+    parse a line of lspci -nm, e.g.
+    00:1f.3 "0403" "8086" "a348" -r10 -p00 "1028" "0869"
+    """
+    options = {}
+    positional = []
+    for token in shlex.split(line):
+        if token.startswith('-r'):
+            options['revision'] = convert2hex(token[2:])
+        elif token.startswith('-p'):
+            options['progif'] = convert2hex(token[2:])
+        else:
+            positional.append(token)
+    slot = positional[0]
+    ids = [convert2hex(arg) for arg in positional[1:6]]
+    ids.extend([None] * (5 - len(ids)))
+    return make_device(slot, *ids, other=positional[6:], **options)
+
 def parse_lspci_data():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-r', '--revision', help='revision', type=convert2hex)
-    parser.add_argument('-p', '--progif', help='proginf', type=convert2hex)
-    parser.add_argument('slot')
-    parser.add_argument('device_class', type=convert2hex)
-    parser.add_argument('vendor_id', type=convert2hex)
-    parser.add_argument('device_id', type=convert2hex)
-    parser.add_argument('sub_vendor_id', type=convert2hex)
-    parser.add_argument('sub_device_id', type=convert2hex)
-    parser.add_argument('other', nargs='*', default=[])
+    output = subprocess.check_output(['lspci', '-nm'], universal_newlines=True)
+    return [parse_lspci_line(line) for line in output.splitlines() if line.strip()]
+
+def read_sysfs_data():
+    """
+    build the same records lspci -nm would return from the sysfs attributes
+    of each pci function
+    """
+    def read_hex(path, attribute):
+        with open(os.path.join(path, attribute)) as f:
+            return int(f.read().strip(), 16)
 
     devices = []
-    for line in subprocess.check_output(['lspci', '-nm'], universal_newlines=True).splitlines():
-        args = parser.parse_args(args=shlex.split(line))
-        devices.append(vars(args))
+    paths = sorted(glob.glob(os.path.join(PCI_SYSFS, '*:*:*.*')))
+    for path in paths:
+        slot = os.path.basename(path)
+        # like lspci -m we only show the pci domain of a device if it isn't 0000
+        if slot.startswith('0000:'):
+            slot = slot[5:]
+        pci_class = read_hex(path, 'class')
+        sub_vendor_id = read_hex(path, 'subsystem_vendor') if os.path.exists(os.path.join(path, 'subsystem_vendor')) else 0
+        sub_device_id = read_hex(path, 'subsystem_device') if os.path.exists(os.path.join(path, 'subsystem_device')) else 0
+        if sub_vendor_id in (0, 0xffff):
+            sub_vendor_id = sub_device_id = None
+        devices.append(make_device(
+            slot=slot,
+            device_class=pci_class >> 8,
+            vendor_id=read_hex(path, 'vendor'),
+            device_id=read_hex(path, 'device'),
+            sub_vendor_id=sub_vendor_id,
+            sub_device_id=sub_device_id,
+            revision=read_hex(path, 'revision') or None,
+            progif=pci_class & 0xff or None,
+        ))
     return devices
 
 
 def main():
-    arg_specs = {}
+    arg_specs = {
+        'backend': dict(default='auto', choices=['auto', 'sysfs', 'lspci'], required=False),
+        'cache': dict(default='off', choices=['refresh', 'use', 'off'], required=False),
+        'cache_dir': dict(default='/etc/ansible/facts.d', type='path', required=False),
+    }
     module = AnsibleModule(argument_spec=arg_specs, supports_check_mode=True,)
+    backend = module.params['backend']
+    cache_mode = module.params['cache']
+    cache_file = os.path.join(module.params['cache_dir'], 'pci_facts.cache')
+    cache_params = {k: module.params[k] for k in ('backend',)}
+    if backend == 'auto':
+        backend = 'sysfs' if os.path.isdir(PCI_SYSFS) else 'lspci'
+
+    if cache_mode != 'off':
+        fingerprint = hardware_fingerprint()
+        if cache_mode == 'use':
+            data = load_cache(cache_file, fingerprint, cache_params)
+            if data is not None:
+                module.exit_json(changed=False, ansible_facts=data, msg=data, cached=True)
+
     try:
-        pci_devices = parse_lspci_data()
+        if backend == 'sysfs':
+            pci_devices = read_sysfs_data()
+        else:
+            pci_devices = parse_lspci_data()
     except:
         module.fail_json(msg="Something fatal happened")
     data = {'pci_devices': pci_devices}
-    module.exit_json(changed=False, ansible_facts=data, msg=data)
+    if cache_mode != 'off' and not module.check_mode:
+        try:
+            store_cache(cache_file, fingerprint, cache_params, data)
+        except (IOError, OSError) as e:
+            module.warn("could not write cache file {}: {}".format(cache_file, e))
+    module.exit_json(changed=False, ansible_facts=data, msg=data, cached=False)
 
 if __name__ == '__main__':
     main()
@@ -6,11 +6,12 @@
 
 from __future__ import absolute_import, division, print_function
 __metaclass__ = type
+import ctypes
+import os
 import traceback
 
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils._text import to_native
-import subprocess
 
 
 ANSIBLE_METADATA = {'metadata_version': '1.1',
@@ -27,85 +28,149 @@ author:
 description:
     - Unload kernel modules and their dependencies with rmmod.
     - Builtin kernel modules can't be removed (will do nothing in this case).
+    - The unload order is computed once from /proc/modules, modules are unloaded
+      after all modules which use them. In check mode only the plan is reported.
 options:
     name:
         required: true
+        type: list
+        elements: str
         description:
-            - Name of kernel module to remove.
+            - Name (or list of names) of kernel modules to remove.
+    method:
+        required: false
+        default: rmmod
+        choices: [ rmmod, modprobe, delete_module ]
+        description:
+            - rmmod - a single rmmod call for all modules of the unload plan
+            - modprobe - a single modprobe -r call, this also removes dependencies which are unused afterwards
+            - delete_module - call the delete_module syscall for each module without spawning a process
 '''
 
 EXAMPLES = '''
 - name: Unload nouveau module
   rmmod:
     name: nouveau
-'''
-
 
+- name: Unload the kms drivers
+  rmmod:
+    name:
+      - nouveau
+      - ttm
+      - drm_kms_helper
+      - drm
+'''
 
-def find_dependencies(module, dependencies=[]):
-    dependencies.append(module)
-    if module in dependency_map:
-        for dependency in dependency_map[module]:
-            find_dependencies(dependency, dependencies)
-    return dependencies
+RETURN = '''
+plan:
+    description: the modules in the order they are (or would be) unloaded
+    type: list
+unloaded_modules:
+    description: the modules which have been unloaded
+    type: list
+in_use:
+    description: modules of the plan with users which are not kernel modules (e.g. open device files)
+    type: dict
+'''
 
 
-def build_module_dependency_map():
-    dependency_map = {}
-    with subprocess.Popen(['lsmod'],
-                          stdout=subprocess.PIPE,
-                          universal_newlines=True
-                          ) as p:
-        for line in p.stdout:
-            values = line.split()
-            if len(values) > 3:
-                #print("module {} depends on {}".format(values[0], values[3]))
-                dependency_map[values[0]] = values[3].split(',')
-    return dependency_map
+def read_proc_modules(proc_modules='/proc/modules'):
+    """
+    returns a dict with the reference count and the holders
+    (the modules which use it) for each loaded module
+    """
+    loaded_modules = {}
+    with open(proc_modules) as f:
+        for line in f:
+            name, _, refcount, holders, *_ = line.split()
+            loaded_modules[name] = {
+                'refcount': int(refcount) if refcount.isdigit() else 0,
+                'holders': [h for h in holders.split(',') if h not in ('', '-')],
+            }
+    return loaded_modules
+
+
+def unload_plan(names, loaded_modules):
+    """
+    returns the names of all loaded modules which need to be unloaded in a
+    topological order, holders are always unloaded before the modules they use
+    """
+    plan = []
+    visited = set()
+
+    def visit(name):
+        if name in visited or name not in loaded_modules:
+            return
+        visited.add(name)
+        for holder in loaded_modules[name]['holders']:
+            visit(holder)
+        plan.append(name)
+
+    for name in names:
+        visit(name.replace('-', '_'))
+    return plan
+
+
+def delete_module(name):
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.delete_module(name.encode(), os.O_NONBLOCK) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, "{}: {}".format(name, os.strerror(errno)))
 
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            name=dict(type='str', required=True),
+            name=dict(type='list', elements='str', required=True),
+            method=dict(type='str', default='rmmod', choices=['rmmod', 'modprobe', 'delete_module']),
         ),
         supports_check_mode=True,
     )
 
-    name = module.params['name']
+    names = module.params['name']
+    method = module.params['method']
 
     result = dict(
         changed=False,
-        name=name,
-        unloaded_modules = list()
+        name=names,
+        plan=list(),
+        unloaded_modules=list(),
+        in_use=dict(),
     )
 
-    # Check if module is loaded
     try:
-        is_loaded = False
-        with open('/proc/modules') as modules:
-            module_name = name.replace('-', '_') + ' '
-            for line in modules:
-                if line.startswith(module_name):
-                    is_loaded = True
-                    break
+        loaded_modules = read_proc_modules()
     except IOError as e:
         module.fail_json(msg=to_native(e), exception=traceback.format_exc(), **result)
 
-    # remove module if it is loaded
-    if is_loaded:
-        if not module.check_mode:
-            dependency_map = build_module_dependency_map()
-            all_modules = find_dependencies(name)
-            all_modules.reverse()
-            for kernel_module in all_modules:
-                rc, out, err = module.run_command([module.get_bin_path('rmmod', True), kernel_module])
-                if rc != 0:
-                    module.fail_json(msg=err, rc=rc, stdout=out, stderr=err, **result)
-                else:
-                    result['unloaded_modules'].append(kernel_module)
-            if result['unloaded_modules']:
-                result['changed'] = True
+    plan = unload_plan(names, loaded_modules)
+    result['plan'] = plan
+    result['in_use'] = {m: loaded_modules[m]['refcount'] - len(loaded_modules[m]['holders'])
+                        for m in plan
+                        if loaded_modules[m]['refcount'] > len(loaded_modules[m]['holders'])}
+
+    # remove the modules if they are loaded
+    if plan and not module.check_mode:
+        if method == 'delete_module':
+            for kernel_module in plan:
+                try:
+                    delete_module(kernel_module)
+                except OSError as e:
+                    module.fail_json(msg=to_native(e), **result)
+                result['unloaded_modules'].append(kernel_module)
+        else:
+            if method == 'modprobe':
+                cmd = [module.get_bin_path('modprobe', True), '-r'] + plan
+            else:
+                cmd = [module.get_bin_path('rmmod', True)] + plan
+            rc, out, err = module.run_command(cmd)
+            still_loaded = read_proc_modules()
+            result['unloaded_modules'] = [m for m in plan if m not in still_loaded]
+            if rc != 0:
+                module.fail_json(msg=err, rc=rc, stdout=out, stderr=err, **result)
+        result['changed'] = bool(result['unloaded_modules'])
+    elif plan:
+        result['changed'] = True
 
     module.exit_json(**result)
 
@@ -1,26 +1,67 @@
 #!/usr/bin/env python3
 DOCUMENTATION = '''
 ---
-module: hardware_facts
+module: satip_facts
 short_description: "check if at least one SAT>IP server responds on the network"
 description:
      - This script sends a multicast message and awaits responses by Sat>IP servers.
        Returns a list of detected SAT>IP servers with their name and capabilites.
+options:
+    expected_servers:
+        required: False
+        default: 0
+        description:
+          - stop listening as soon as this number of SAT>IP servers has answered,
+            0 waits for the whole response window (MX + 0.5 s)
+    fetch_timeout:
+        required: False
+        default: 2
+        description:
+          - timeout in seconds for fetching the device description of a server
+    cache:
+        required: False
+        default: 'off'
+        choices: [ 'refresh', 'use', 'off' ]
+        description:
+          - use - serve device descriptions from the cache while they are fresh according to
+            the CACHE-CONTROL max-age of the SSDP response, revalidate stale entries
+            with If-None-Match/If-Modified-Since
+          - refresh - always download the device descriptions and update the cache
+          - off - neither read nor write the cache
+    cache_dir:
+        required: False
+        default: /etc/ansible/facts.d
+        description:
+          - directory for the cache file (satip_facts.cache)
 '''
 EXAMPLES = '''
 - name: "detect SAT>IP Server on the network"
   action: satip_facts
 
+- name: "detect two SAT>IP Servers, don't wait for the rest of the response window"
+  satip_facts:
+    expected_servers: 2
+
 - debug:
     var: satip_devices
+
+- name: "show discovery latency and cache usage for each server"
+  debug:
+    var: satip_servers
 '''
 
 import json
+import os
+import re
+import selectors
 import socket
 import sys
 import time
 import xml.etree.ElementTree as ET
 import requests
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from ansible.module_utils.basic import *
 
@@ -51,7 +92,6 @@ def socket_manager(*args, **kwargs):
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     except socket.error:
         pass
-    sock.settimeout(SSDP_MX + 0.5)
     sock.bind((SSDP_BIND, SSDP_PORT))
     try:
         yield sock
@@ -86,33 +126,182 @@ def parse_satip_xml(data):
     return result
 
 
-def main():
-    description_urls = []
-    device_list = []
-    module = AnsibleModule(argument_spec={}, supports_check_mode=True,)
-    with socket_manager(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        # according to Sat>IP Specification 1.2.2, p. 20
-        # a client should send three requests within 100 ms with a ttl of 2
+def parse_ssdp_message(data):
+    """ Parse the header lines of a SSDP message.
+    Args:
+        data (str): SSDP message.
+    Returns:
+        dict: header fields with upper case names.
+    """
+    headers = {}
+    for line in data.splitlines()[1:]:
+        key, sep, value = line.partition(':')
+        if sep:
+            headers[key.strip().upper()] = value.strip()
+    return headers
+
 
-        for _ in range(3):
-            sock.sendto(ssdpRequest, (SSDP_ADDR, SSDP_PORT))
+def send_requests(sock):
+    """ Send the M-SEARCH requests.
+    According to Sat>IP Specification 1.2.2, p. 20 a client should send three requests
+    within 100 ms with a ttl of 2.
+    Args:
+        sock (socket.socket): socket to send the requests from.
+    Returns:
+        float: time.monotonic() after the last request, the latency of the servers is measured from it.
+    """
+    for n in range(3):
+        if n:
             time.sleep(0.03)
+        sock.sendto(ssdpRequest, (SSDP_ADDR, SSDP_PORT))
+    return time.monotonic()
+
+
+def collect_responses(sock, timeout, expected_servers=0):
+    """ Collect the answers of all SAT>IP servers within the response window.
+    Args:
+        sock (socket.socket): non-blocking socket the M-SEARCH requests were sent from.
+        timeout (float): length of the response window in seconds.
+        expected_servers (int): return early if this number of servers has answered.
+    Returns:
+        OrderedDict: SSDP headers and time of arrival (time.monotonic()) of each server by their LOCATION.
+    """
+    servers = OrderedDict()
+    deadline = time.monotonic() + timeout
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+        while not expected_servers or len(servers) < expected_servers:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not selector.select(remaining):
+                break
+            try:
+                data = sock.recv(2048).decode('utf-8', errors='replace')
+            except (BlockingIOError, InterruptedError):
+                continue
+            headers = parse_ssdp_message(data)
+            location = headers.get('LOCATION')
+            # ignore our own M-SEARCH requests and other UPnP devices
+            if location and headers.get('ST', headers.get('NT')) == SSDP_ST:
+                servers.setdefault(location, (headers, time.monotonic()))
+    return servers
+
+
+def max_age(headers):
+    """ Get the max-age in seconds from the CACHE-CONTROL header of a SSDP response (0 if missing). """
+    match = re.search(r'max-age\s*=\s*(\d+)', headers.get('CACHE-CONTROL', ''))
+    return int(match.group(1)) if match else 0
+
+
+def load_cache(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def store_cache(cache_file, cache):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_file, cache_file)
+
+
+def fetch_descriptions(servers, timeout, cache=None):
+    """ Fetch and parse the device descriptions of all servers concurrently.
+    Args:
+        servers (list): dicts with the 'location', 'usn' and 'max_age' of each SAT>IP server.
+        timeout (float): timeout for each request in seconds.
+        cache (dict): cache entries by USN (or LOCATION), updated in place; None disables the cache.
+    Returns:
+        list: (server, device) tuples, servers with invalid descriptions are skipped.
+              server['cache'] is set to 'hit', 'revalidated' or 'miss'.
+    """
+    def fetch(server):
+        entry = cache.get(server['key']) if cache is not None else None
+        if entry and entry.get('location') != server['location']:
+            entry = None
+        if entry and entry['expires'] > now:
+            server['cache'] = 'hit'
+            return server, entry['device']
+        request_headers = {}
+        if entry and entry.get('etag'):
+            request_headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            request_headers['If-Modified-Since'] = entry['last_modified']
         try:
-            response = sock.recv(1024).decode()
-            if response and "SERVER:" in response:
-                for line in response.splitlines():
-                    if "LOCATION" in line:
-                        url = line.split()[-1].strip()
-                        if url not in description_urls:
-                            description_urls.append(url)
-                            info = requests.get(url, timeout=2)
-                            device_list.append(parse_satip_xml(info.text))
+            response = session.get(server['location'], headers=request_headers, timeout=timeout)
+            if entry and response.status_code == 304:
+                server['cache'] = 'revalidated'
+                device = entry['device']
             else:
-                raise ValueError('No satip server detected')
-        except (socket.timeout, ValueError, ET.ParseError):
-            pass
+                response.raise_for_status()
+                server['cache'] = 'miss'
+                device = parse_satip_xml(response.text)
+        except (requests.RequestException, ValueError, ET.ParseError):
+            return server, None
+        if cache is not None:
+            cache[server['key']] = {
+                'location': server['location'],
+                'expires': now + server['max_age'],
+                'etag': response.headers.get('ETag', entry and entry.get('etag')),
+                'last_modified': response.headers.get('Last-Modified', entry and entry.get('last_modified')),
+                'device': device,
+            }
+        return server, device
+
+    if not servers:
+        return []
+    now = time.time()
+    with requests.Session() as session:
+        adapter = HTTPAdapter(pool_maxsize=len(servers))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        with ThreadPoolExecutor(max_workers=len(servers)) as executor:
+            return [(server, device) for server, device in executor.map(fetch, servers) if device is not None]
+
+
+def main():
+    arg_specs = {
+        'expected_servers': dict(default=0, type='int', required=False),
+        'fetch_timeout': dict(default=2, type='float', required=False),
+        'cache': dict(default='off', choices=['refresh', 'use', 'off'], required=False),
+        'cache_dir': dict(default='/etc/ansible/facts.d', type='path', required=False),
+    }
+    module = AnsibleModule(argument_spec=arg_specs, supports_check_mode=True,)
+    cache_mode = module.params['cache']
+    cache_file = os.path.join(module.params['cache_dir'], 'satip_facts.cache')
+
+    with socket_manager(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sent = send_requests(sock)
+        responses = collect_responses(sock, SSDP_MX + 0.5, module.params['expected_servers'])
+
+    servers = [{'location': location,
+                'usn': headers.get('USN'),
+                'key': headers.get('USN') or location,
+                'max_age': max_age(headers),
+                'latency': round(received - sent, 3),
+                'cache': 'miss'} for location, (headers, received) in responses.items()]
+
+    cache = None
+    if cache_mode == 'use':
+        cache = load_cache(cache_file)
+    elif cache_mode == 'refresh':
+        cache = {}
+    results = fetch_descriptions(servers, module.params['fetch_timeout'], cache)
+    if cache is not None and not module.check_mode:
+        # forget servers which did not answer and whose entries are stale anyway
+        seen = {server['key'] for server in servers}
+        cache = {key: entry for key, entry in cache.items() if key in seen or entry['expires'] > time.time()}
+        try:
+            store_cache(cache_file, cache)
+        except (IOError, OSError) as e:
+            module.warn("could not write cache file {}: {}".format(cache_file, e))
 
-    module.exit_json(changed=False, ansible_facts={'satip_devices': device_list})
+    device_list = [device for server, device in results]
+    server_list = [{k: server[k] for k in ('location', 'usn', 'latency', 'cache')} for server, device in results]
+    module.exit_json(changed=False, ansible_facts={'satip_devices': device_list, 'satip_servers': server_list})
 
 if __name__ == '__main__':
     main()
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 from __future__ import print_function
-import ast
 import binascii
 import csv
+import hashlib
+import json
 import os
 import re
 import subprocess
@@ -17,23 +18,43 @@ module: xrandr_facts
 short_description: "gather facts about connected monitors and available modelines"
 description:
      - This module needs a running x-server on a given display in
-       order to successfully call xrandr. Returns the dictionary
+       order to successfully call xrandr (unless backend is drm). Returns the dictionary
        "xrandr", wich contains all screens with output states,
        connected displays, EDID info and their modes and a
        recommendation for the best fitting tv mode, the dictionary
        "xorg" with a recommendation for the primary and secondary
-       output and a "drm" dictionary whose "primary" key associates
+       output (and all modes of each connector ranked from the best
+       to the worst choice in "candidates") and a "drm" dictionary whose "primary" key associates
        the primary device name of the drm subsystem with the one from
-       the xrandr output by comparing the edid data and a list of
-       "ignored_devices". Note that the proprietary nvidia driver
+       the xrandr output by comparing the edid data (on all drm cards), a list of
+       "ignored_outputs" (connector names not used by the primary or secondary
+       display on any card) and all drm connectors with their card in
+       "connectors". Note that the proprietary nvidia driver
        doesn't support KMS/drm, so in this case the dictionary is
-       always empty.
+       always empty. All GPUs driven by the nvidia driver are listed
+       in "nvidia_gpus" of "xorg" (name, PCI slot and xorg BusID),
+       the primary and secondary output use the first one.
 options:
     display:
         required: False
         default: ":0"
         description:
           - the DISPLAY variable to use when calling xrandr
+    backend:
+        required: False
+        default: "xrandr"
+        choices: ["xrandr", "drm"]
+        description:
+          - xrandr - parse the output of xrandr --verbose
+          - drm - build the same data from /sys/class/drm/card*-*/ (status, modes, edid, enabled)
+            and the detailed timings and CTA-861 video formats of the EDIDs, this doesn't
+            need a running x-server but only works for KMS drivers (not for the
+            proprietary nvidia driver). The output names follow the naming of the
+            modesetting X driver (e.g. HDMI-1), or of amdgpu and radeon (e.g. HDMI-A-0)
+            for cards using these drivers. If a name is already taken by a connector of a
+            card with a lower number, the card number is appended (e.g. HDMI-1-1 for
+            card1-HDMI-A-1), these names don't necessarily match the names xrandr
+            uses for the outputs of a second GPU.
     preferred_outputs:
         required: False
         default: ["HDMI", "DP", "eDP", "DVI", "VGA", "TV", "Virtual"]
@@ -54,7 +75,39 @@ options:
         default: True
         description:
            - write edid data to /etc/X11/edid.{connector}.bin
+           - a file is only replaced (atomically) if its sha256 differs from the
+             one of the EDID ("edid_sha256" of each connector), changed is True
+             if at least one file was written
            - the dictionary "drm" can only be filled with data if write_edids is enabled
+    edid_parser:
+        required: False
+        default: "builtin"
+        choices: ["builtin", "edid-decode", "cross-check"]
+        description:
+           - builtin - decode vendor, model and detailed timings of the EDID in python
+           - edid-decode - use the output of edid-decode (package edid-decode)
+           - cross-check - use the builtin decoder and warn if edid-decode disagrees
+    cache:
+        required: False
+        default: "off"
+        choices: ["use", "refresh", "lookup", "off"]
+        description:
+           - the results are cached for the set of EDIDs found in /sys/class/drm/card*-*/
+             and the preferred_* parameters
+           - use - return the cached results if the displays are known, call xrandr otherwise
+           - refresh - always call xrandr and update the cache
+           - lookup - return the cached results if the displays are known, otherwise
+             return cached=False without facts, this doesn't need a running x-server
+           - off - neither read nor write the cache
+           - drivers without KMS support (like the proprietary nvidia driver) can't be cached
+           - this doesn't apply to the list of nvidia GPUs, see cache_dir
+    cache_dir:
+        required: False
+        default: "/etc/ansible/facts.d"
+        description:
+           - directory for the cache file (xrandr_facts.cache)
+           - the nvidia GPUs are kept in xrandr_facts.gpus.cache until the next boot
+             (it is keyed on the boot id), independently of the cache option
 '''
 EXAMPLES = '''
 - name: "collect facts for connected displays"
@@ -69,10 +122,20 @@ EXAMPLES = '''
 
 - debug:
     var: drm
+
+- name: "collect facts for connected displays without an x-server"
+  xrandr_facts:
+    backend: drm
+
+- name: "use the cached facts for the connected displays if they are known"
+  xrandr_facts:
+    cache: lookup
+  register: display_profile
 '''
 
 ARG_SPECS = {
     'display': dict(default=":0", type='str', required=False),
+    'backend': dict(default='xrandr', choices=['xrandr', 'drm'], required=False),
     'preferred_outputs': dict(
         default=["HDMI", "DP", "eDP", "DVI", "VGA", "TV", "Virtual"],
         type='list', elements='str', required=False
@@ -84,8 +147,28 @@ ARG_SPECS = {
             "7680x4320", "3840x2160", "1920x1080", "1280x720", "720x576"],
         type='list', elements='str', required=False),
     'write_edids': dict(default=True, type='bool', required=False),
+    'edid_parser': dict(default='builtin', choices=['builtin', 'edid-decode', 'cross-check'],
+                        required=False),
+    'cache': dict(default='off', choices=['use', 'refresh', 'lookup', 'off'], required=False),
+    'cache_dir': dict(default='/etc/ansible/facts.d', type='path', required=False),
 }
 
+# number of display profiles to keep in the cache
+CACHED_PROFILES = 8
+
+EDID_FILE = '/etc/X11/edid.{}.bin'
+DRM_SYSFS = '/sys/class/drm'
+NVIDIA_PROC = '/proc/driver/nvidia/gpus'
+PCI_SYSFS = '/sys/bus/pci/devices'
+NVIDIA_VENDOR_ID = '10de'
+DISPLAY_CLASS = '03'
+PCI_ADDRESS_REGEX = re.compile(
+    r'(?P<domain>[0-9a-fA-F]+):(?P<bus>[0-9a-fA-F]+):(?P<device>[0-9a-fA-F]+)\.(?P<function>[0-9a-fA-F]+)')
+DRM_CONNECTOR_REGEX = re.compile(r'^(?P<card>card\d+)-(?P<connector>.+)$')
+# names of the drm connector types which differ in the X drivers
+MODESETTING_CONNECTOR_TYPES = {'HDMI-A': 'HDMI'}
+AMDGPU_CONNECTOR_TYPES = {'DP': 'DisplayPort', 'SVIDEO': 'S-video', 'Component': 'CTV'}
+
 SCREEN_REGEX = re.compile(r"^(?P<screen>Screen\s\d+:)(?:.*)")
 CONNECTOR_REGEX = re.compile(
     r"^(?P<connector>.*-?\d+)\s(?P<connection_state>connected|disconnected)\s(?P<primary>primary)?")
@@ -96,14 +179,14 @@ Mode = namedtuple('Mode', ['connection', 'resolution', 'refreshrate'])
 
 def check_for_screen(line):
     """check line for screen information"""
-    match = re.match(SCREEN_REGEX, line)
+    match = SCREEN_REGEX.match(line)
     if match:
         return match.groupdict()['screen']
 
 
 def check_for_connection(line):
     """check line for connection name and state"""
-    match = re.match(CONNECTOR_REGEX, line)
+    match = CONNECTOR_REGEX.match(line)
     connector = None
     is_connected = False
     if match:
@@ -118,106 +201,143 @@ def get_indentation(line):
     return len(line) - len(line.lstrip())
 
 
-def sort_mode(mode):
-    """rate modes by several criteria"""
-    connection_score = 0
-    rrate_score = 0
-    resolution_score = 0
-    preferred_rrates = module.params['preferred_refreshrates']
+def mode_ranking(preferred_refreshrates, preferred_resolutions, preferred_outputs):
+    """
+    return a function which rates modes by several criteria,
+    the scores for the preferences are looked up in precomputed tables
+    """
+    def scores(preferences):
+        # earlier entries win if a preference is listed twice
+        return {value: len(preferences) - i for i, value in reversed(list(enumerate(preferences)))}
+
+    rrate_scores = scores(preferred_refreshrates)
     # [50, 60]
-    preferred_resolutions = module.params['preferred_resolutions']
+    resolution_scores = scores(preferred_resolutions)
     # ["7680x4320", "3840x2160", "1920x1080", "1280x720", "720x576"]
-    preferred_outputs = module.params['preferred_outputs']
+    output_scores = scores(preferred_outputs)
     # ["HDMI", "DP", "DVI", "VGA"]
-    if mode.refreshrate in preferred_rrates:
-        rrate_score = len(preferred_rrates) - preferred_rrates.index(mode.refreshrate)
-    if mode.resolution in preferred_resolutions:
-        resolution_score = len(preferred_resolutions) - preferred_resolutions.index(mode.resolution)
-    x_resolution, y_resolution = (int(n) for n in mode.resolution.split('x'))
-    connection = mode.connection.split('-')[0]
-    if connection in preferred_outputs:
-        connection_score = len(preferred_outputs) - preferred_outputs.index(connection)
-    return (rrate_score, resolution_score, x_resolution, y_resolution, connection_score)
-
-
-def parse_xrandr_verbose(iterator):
-    """parse the output of xrandr --verbose using an iterator delivering single lines"""
+
+    def score_mode(mode):
+        x_resolution, _, y_resolution = mode.resolution.partition('x')
+        return (rrate_scores.get(mode.refreshrate, 0),
+                resolution_scores.get(mode.resolution, 0),
+                int(x_resolution), int(y_resolution),
+                output_scores.get(mode.connection.split('-')[0], 0))
+    return score_mode
+
+
+def rank_modes(modes, score_mode):
+    """
+    score all modes once and return a dict with the modes of each
+    connector sorted from the best to the worst candidate
+    """
+    candidates = {}
+    for score, mode in sorted(((score_mode(mode), mode) for mode in modes),
+                              key=lambda scored: scored[0], reverse=True):
+        candidates.setdefault(mode.connection, []).append(mode)
+    return candidates
+
+
+def best_connector(candidates, score_mode, exclude=()):
+    """return the connector whose best mode has the highest score"""
+    connectors = [c for c in candidates if c not in exclude]
+    if not connectors:
+        return None
+    return max(connectors, key=lambda c: score_mode(candidates[c][0]))
+
+
+def parse_xrandr_verbose(lines):
+    """
+    parse the output of xrandr --verbose line by line
+
+    lines may be any iterable delivering single lines (like the stdout of
+    a subprocess), every line is looked at exactly once. The parser keeps
+    track of the EDID block and the mode whose timing lines (h:, v:) are
+    expected next - a mode is dropped if its timing lines are missing
+    (e.g. if the output has been truncated).
+    """
     xorg = {}
-    is_connected = False
-    for line in iterator:
-        if line.startswith("Screen"):
-            screen = check_for_screen(line)
-            xorg[screen] = {}
-        elif "connected" in line:
-            connector, is_connected = check_for_connection(line)
-            xorg[screen][connector] = {
-                "is_connected": is_connected,
-                "EDID": "",
-                "modes": {},
-                "modelines": {},
-                "preferred": "",
-                "current": "",
-                "auto": "",
-            }
-        elif is_connected and "EDID:" in line:
-            edid_str = ""
-            outer_indentation = get_indentation(line)
-            while True:
-                line = next(iterator)
-                if get_indentation(line) > outer_indentation:
-                    edid_str += line.strip()
-                else:
-                    break
-            xorg[screen][connector]["EDID"] = edid_str
-        elif is_connected and "MHz" in line and "Interlace" not in line:
-            match = re.match(MODE_REGEX, line)
+    outputs = None            # connectors of the current screen
+    output = None             # data of the current connected output
+    edid_indentation = None   # set while reading the lines of an EDID block
+    mode = None               # mode waiting for its timing lines
+    for line in lines:
+        line = line.rstrip('\n')
+        if edid_indentation is not None:
+            if get_indentation(line) > edid_indentation:
+                output["EDID"] += line.strip()
+                continue
+            edid_indentation = None
+
+        stripped = line.strip()
+        if mode is not None:
+            if stripped.startswith("h:"):
+                mode["h"] = stripped.split()
+                continue
+            if stripped.startswith("v:") and "h" in mode:
+                add_mode(output, mode, stripped.split())
+                mode = None
+                continue
+            mode = None
+
+        if not line[:1].isspace():
+            output = None
+            if line.startswith("Screen"):
+                outputs = xorg.setdefault(check_for_screen(line), {})
+            elif outputs is not None and "connected" in line:
+                connector, is_connected = check_for_connection(line)
+                outputs[connector] = {
+                    "is_connected": is_connected,
+                    "EDID": "",
+                    "modes": {},
+                    "modelines": {},
+                    "preferred": "",
+                    "current": "",
+                    "auto": "",
+                }
+                if is_connected:
+                    output = outputs[connector]
+        elif output is None:
+            continue
+        elif stripped == "EDID:":
+            edid_indentation = get_indentation(line)
+        elif "MHz" in line and "Interlace" not in line:
+            match = MODE_REGEX.match(line)
             if match:
-                match = match.groupdict()
-                preferred = bool("+preferred" in line)
-                current = bool("*current" in line)
-                resolution, mode_num, pixel_clk, *flags = line.split()
-                flags = [flag for flag in flags if flag not in ("*current", "+preferred")]
-                pixel_clk = pixel_clk[:-3]
-
-                while True:
-                    line = next(iterator).strip()
-                    if line.startswith("h:"):
-                        _, _, h_width, _, h_start, _, h_end, _, h_total, _, h_skew, _, h_clock = (
-                            line.split()
-                        )
-                        h_clock = h_clock[:-3]
-
-                    if line.startswith("v:"):
-                        _, _, v_height, _, v_start, _, v_end, _, v_total, _, v_clock = (
-                            line.split()
-                        )
-                        refresh_rate = ast.literal_eval(v_clock[:-2])
-                        rrate = int(round(refresh_rate))
-                        if (
-                            xorg[screen][connector]["modes"].get(match["resolution"])
-                            is None
-                        ):
-                            xorg[screen][connector]["modes"][match["resolution"]] = []
-                        if (
-                            rrate
-                            not in xorg[screen][connector]["modes"][match["resolution"]]
-                        ):
-                            xorg[screen][connector]["modes"][
-                                match["resolution"]
-                            ].append(rrate)
-                        mode_name = f'{match["resolution"]}_{rrate}'
-                        if preferred:
-                            xorg[screen][connector]["preferred"] = mode_name
-                        if current:
-                            xorg[screen][connector]["current"] = mode_name
-                        modeline = (
-                            f'Modeline "{mode_name}"  {pixel_clk} {h_width} {h_start} {h_end} {h_total} {v_height} {v_start} {v_end} {v_total} {" ".join(flags)}'
-                        )
-                        xorg[screen][connector]["modelines"][mode_name] = modeline
-                        break
+                _, _, pixel_clk, *flags = stripped.split()
+                mode = {
+                    "resolution": match.group("resolution"),
+                    "pixel_clk": pixel_clk[:-3],
+                    "preferred": "+preferred" in flags,
+                    "current": "*current" in flags,
+                    "flags": [flag for flag in flags if flag not in ("*current", "+preferred")],
+                }
     return xorg
 
 
+def add_mode(output, mode, v_fields):
+    """add a mode with its timings (fields of the h: and v: lines) to the output data"""
+    try:
+        _, _, h_width, _, h_start, _, h_end, _, h_total, _, h_skew, _, h_clock = mode["h"]
+        _, _, v_height, _, v_start, _, v_end, _, v_total, _, v_clock = v_fields
+        rrate = int(round(float(v_clock[:-2])))
+    except ValueError:
+        # incomplete timing information
+        return
+    resolution = mode["resolution"]
+    rrates = output["modes"].setdefault(resolution, [])
+    if rrate not in rrates:
+        rrates.append(rrate)
+    mode_name = f'{resolution}_{rrate}'
+    if mode["preferred"]:
+        output["preferred"] = mode_name
+    if mode["current"]:
+        output["current"] = mode_name
+    output["modelines"][mode_name] = (
+        f'Modeline "{mode_name}"  {mode["pixel_clk"]} {h_width} {h_start} {h_end} {h_total} {v_height} {v_start} {v_end} {v_total} {" ".join(mode["flags"])}'
+    )
+
+
 Modeline_Data = namedtuple("Modeline", [
     "pixelclock",
     "hdisp", "hsyncstart", "hsyncend", "htotal",
@@ -225,36 +345,216 @@ Modeline_Data = namedtuple("Modeline", [
     "flags"])
 
 
-def parse_edid_data(edid):
+EDID_HEADER = b'\x00\xff\xff\xff\xff\xff\xff\x00'
+EDID_BLOCK_SIZE = 128
+DESCRIPTOR_SIZE = 18
+CTA_EXTENSION_TAG = 0x02
+PRODUCT_NAME_TAG = 0xfc
+
+
+def edid_descriptors(edid):
+    """
+    yield the 18 byte descriptors of the base block and the
+    detailed timing descriptors of all CTA-861 extension blocks
+    """
+    for offset in range(54, 126, DESCRIPTOR_SIZE):
+        yield edid[offset:offset + DESCRIPTOR_SIZE]
+    for block in range(1, len(edid) // EDID_BLOCK_SIZE):
+        ext = edid[block * EDID_BLOCK_SIZE:(block + 1) * EDID_BLOCK_SIZE]
+        if ext[0] != CTA_EXTENSION_TAG or ext[2] < 4:
+            continue
+        for offset in range(ext[2], EDID_BLOCK_SIZE - DESCRIPTOR_SIZE, DESCRIPTOR_SIZE):
+            dtd = ext[offset:offset + DESCRIPTOR_SIZE]
+            if dtd[0] == dtd[1] == 0:
+                break
+            yield dtd
+
+
+def decode_dtd(dtd):
+    """
+    convert a detailed timing descriptor into a modeline,
+    returns None for display descriptors
+    For the fields of a modeline see
+    https://en.wikipedia.org/wiki/XFree86_Modeline
+    """
+    pixelclock = int.from_bytes(dtd[0:2], 'little') * 10  # kHz
+    if not pixelclock:
+        return None
+    hdisp = dtd[2] | (dtd[4] & 0xf0) << 4
+    hblank = dtd[3] | (dtd[4] & 0x0f) << 8
+    vdisp = dtd[5] | (dtd[7] & 0xf0) << 4
+    vblank = dtd[6] | (dtd[7] & 0x0f) << 8
+    hsync_offset = dtd[8] | (dtd[11] & 0xc0) << 2
+    hsync_width = dtd[9] | (dtd[11] & 0x30) << 4
+    vsync_offset = dtd[10] >> 4 | (dtd[11] & 0x0c) << 2
+    vsync_width = dtd[10] & 0x0f | (dtd[11] & 0x03) << 4
+    interlaced = bool(dtd[17] & 0x80)
+    # the vertical values of interlaced modes describe a single field
+    mult = 2 if interlaced else 1
+    vdisp *= mult
+    vtotal = vdisp + vblank * mult + interlaced
+    htotal = hdisp + hblank
+    if dtd[17] & 0x18 == 0x18:
+        # digital separate sync
+        vsync = '+VSync' if dtd[17] & 0x04 else '-VSync'
+    else:
+        vsync = '-VSync'
+    hsync = '+HSync' if dtd[17] & 0x02 else '-HSync'
+    flags = [hsync, vsync] + (['Interlace'] if interlaced else [])
+    refresh = int(round(pixelclock * 1E3 / (htotal * vtotal)))
+    timings = (hdisp, hdisp + hsync_offset, hdisp + hsync_offset + hsync_width, htotal,
+               vdisp, vdisp + vsync_offset * mult, vdisp + (vsync_offset + vsync_width) * mult, vtotal)
+    return 'Modeline "{}x{}_{}{}" {:.3f} {} {}'.format(
+        hdisp, vdisp, refresh, "i" if interlaced else "", pixelclock / 1000,
+        " ".join(str(t) for t in timings), " ".join(flags))
+
+
+def decode_edid(edid):
+    """decode vendor, model and the modelines of all detailed timings from the raw EDID bytes"""
+    vendor = "Unknown"
+    model = "Unknown"
+    modelines = []
+    if len(edid) < EDID_BLOCK_SIZE or not edid.startswith(EDID_HEADER):
+        return vendor, model, modelines
+    manufacturer = int.from_bytes(edid[8:10], 'big')
+    vendor = "".join(chr(ord('A') - 1 + (manufacturer >> shift & 0x1f)) for shift in (10, 5, 0))
+    for descriptor in edid_descriptors(edid):
+        if descriptor[0] == descriptor[1] == 0:
+            if descriptor[3] == PRODUCT_NAME_TAG:
+                model = descriptor[5:].split(b'\n', 1)[0].decode('cp437').strip()
+            continue
+        modeline = decode_dtd(descriptor)
+        if modeline not in modelines:
+            modelines.append(modeline)
+    return vendor, model, modelines
+
+
+Timing = namedtuple('Timing', ['resolution', 'refreshrate', 'interlaced', 'timings'])
+
+DTD_MODELINE_REGEX = re.compile(
+    r'Modeline "(?P<resolution>\d+x\d+)_(?P<refreshrate>\d+)(?P<interlaced>i?)" (?P<timings>.*)')
+VIDEO_DATA_BLOCK_TAG = 2
+# progressive CTA-861 video formats by their VIC:
+# resolution, refresh rate, pixel clock in MHz, horizontal and vertical timings, flags
+CTA_VIDEO_FORMATS = {
+    vic: Timing(resolution, refreshrate, False, timings)
+    for vic, resolution, refreshrate, timings in (
+        (1, "640x480", 60, "25.175 640 656 752 800 480 490 492 525 -HSync -VSync"),
+        (2, "720x480", 60, "27.000 720 736 798 858 480 489 495 525 -HSync -VSync"),
+        (3, "720x480", 60, "27.000 720 736 798 858 480 489 495 525 -HSync -VSync"),
+        (4, "1280x720", 60, "74.250 1280 1390 1430 1650 720 725 730 750 +HSync +VSync"),
+        (16, "1920x1080", 60, "148.500 1920 2008 2052 2200 1080 1084 1089 1125 +HSync +VSync"),
+        (17, "720x576", 50, "27.000 720 732 796 864 576 581 586 625 -HSync -VSync"),
+        (18, "720x576", 50, "27.000 720 732 796 864 576 581 586 625 -HSync -VSync"),
+        (19, "1280x720", 50, "74.250 1280 1720 1760 1980 720 725 730 750 +HSync +VSync"),
+        (31, "1920x1080", 50, "148.500 1920 2448 2492 2640 1080 1084 1089 1125 +HSync +VSync"),
+        (32, "1920x1080", 24, "74.250 1920 2558 2602 2750 1080 1084 1089 1125 +HSync +VSync"),
+        (33, "1920x1080", 25, "74.250 1920 2448 2492 2640 1080 1084 1089 1125 +HSync +VSync"),
+        (34, "1920x1080", 30, "74.250 1920 2008 2052 2200 1080 1084 1089 1125 +HSync +VSync"),
+        (60, "1280x720", 24, "59.400 1280 3040 3080 3300 720 725 730 750 +HSync +VSync"),
+        (61, "1280x720", 25, "74.250 1280 3700 3740 3960 720 725 730 750 +HSync +VSync"),
+        (62, "1280x720", 30, "74.250 1280 3040 3080 3300 720 725 730 750 +HSync +VSync"),
+        (93, "3840x2160", 24, "297.000 3840 5116 5204 5500 2160 2168 2178 2250 +HSync +VSync"),
+        (94, "3840x2160", 25, "297.000 3840 4896 4984 5280 2160 2168 2178 2250 +HSync +VSync"),
+        (95, "3840x2160", 30, "297.000 3840 4016 4104 4400 2160 2168 2178 2250 +HSync +VSync"),
+        (96, "3840x2160", 50, "594.000 3840 4896 4984 5280 2160 2168 2178 2250 +HSync +VSync"),
+        (97, "3840x2160", 60, "594.000 3840 4016 4104 4400 2160 2168 2178 2250 +HSync +VSync"),
+    )
+}
+
+
+# established timings (bytes 35 - 37 of the base block) from the most significant bit on,
+# their modelines are not needed for the ranking and left out
+ESTABLISHED_TIMINGS = (
+    ("720x400", 70), ("720x400", 88), ("640x480", 60), ("640x480", 67),
+    ("640x480", 72), ("640x480", 75), ("800x600", 56), ("800x600", 60),
+    ("800x600", 72), ("800x600", 75), ("832x624", 75), ("1024x768", 87),
+    ("1024x768", 60), ("1024x768", 70), ("1024x768", 75), ("1280x1024", 75),
+    ("1152x870", 75),
+)
+INTERLACED_ESTABLISHED_TIMING = 11
+# aspect ratios of the standard timings (EDID 1.3)
+STANDARD_TIMING_RATIOS = ((16, 10), (4, 3), (5, 4), (16, 9))
+
+
+def vesa_timings(edid):
+    """yield the established and standard timings of the base block (without modelines)"""
+    bits = int.from_bytes(edid[35:38], 'big') >> 7
+    for i, (resolution, refreshrate) in enumerate(ESTABLISHED_TIMINGS):
+        if bits >> (len(ESTABLISHED_TIMINGS) - 1 - i) & 1:
+            yield Timing(resolution, refreshrate, i == INTERLACED_ESTABLISHED_TIMING, None)
+    for offset in range(38, 54, 2):
+        if edid[offset] in (0x00, 0x01) and edid[offset + 1] in (0x00, 0x01):
+            continue
+        width = (edid[offset] + 31) * 8
+        ratio_x, ratio_y = STANDARD_TIMING_RATIOS[edid[offset + 1] >> 6]
+        yield Timing("{}x{}".format(width, width * ratio_y // ratio_x), (edid[offset + 1] & 0x3f) + 60, False, None)
+
+
+def cta_video_codes(edid):
+    """yield the VICs of the short video descriptors of all CTA-861 extension blocks"""
+    for block in range(1, len(edid) // EDID_BLOCK_SIZE):
+        ext = edid[block * EDID_BLOCK_SIZE:(block + 1) * EDID_BLOCK_SIZE]
+        if ext[0] != CTA_EXTENSION_TAG or ext[2] < 4:
+            continue
+        offset = 4
+        while offset < ext[2]:
+            tag, length = ext[offset] >> 5, ext[offset] & 0x1f
+            if tag == VIDEO_DATA_BLOCK_TAG:
+                for svd in ext[offset + 1:offset + 1 + length]:
+                    # bit 7 marks native formats for the VICs 1-64
+                    yield svd & 0x7f if 128 < svd <= 192 else svd
+            offset += length + 1
+
+
+def edid_timings(edid):
+    """
+    yield the timings of the detailed timing descriptors (the preferred one first),
+    of the known CTA-861 video formats and the established and standard timings of an EDID
+    """
+    if len(edid) < EDID_BLOCK_SIZE or not edid.startswith(EDID_HEADER):
+        return
+    for descriptor in edid_descriptors(edid):
+        if descriptor[0] == descriptor[1] == 0:
+            continue
+        match = DTD_MODELINE_REGEX.match(decode_dtd(descriptor))
+        if match:
+            yield Timing(match.group('resolution'), int(match.group('refreshrate')),
+                         bool(match.group('interlaced')), match.group('timings'))
+    for vic in cta_video_codes(edid):
+        if vic in CTA_VIDEO_FORMATS:
+            yield CTA_VIDEO_FORMATS[vic]
+    for timing in vesa_timings(edid):
+        yield timing
+
+
+def run_edid_decode(edid):
     vendor = "Unknown"
     model = "Unknown"
     modelines = []
     try:
-        data = subprocess.check_output(["edid-decode", "-LnpsX", edid],
-                                       errors='replace',
-                                       universal_newlines=True)
-    except subprocess.CalledProcessError:
+        data = subprocess.run(["edid-decode", "-LnpsX", "-"], input=edid, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    except (subprocess.CalledProcessError, OSError):
         pass
     else:
-        for line in data.splitlines():
+        for line in data.decode(errors='replace').splitlines():
             line = line.strip()
             if line.startswith("Manufacturer:"):
                 _, _, vendor = line.partition(': ')
             elif line.startswith("Display Product Name:"):
                 _, _, model = line.partition(': ')
+                model = model.strip("'")
             elif line.startswith("Modeline"):
-                # For the fields of a modeline see
-                # https://en.wikipedia.org/wiki/XFree86_Modeline
-                print(line)
                 # ignore 'Modeline "Mode N"' part of Modeline
                 _, _, line = line.split('"', 2)
                 if not line:
-                    print("no timing information")
+                    # no timing information
                     continue
                 try:
                     mode = Modeline_Data(*line.split(None, 9))
                 except (ValueError, TypeError):
-                    print("invalid timing information")
+                    # invalid timing information
                     continue
                 refresh = round(float(mode.pixelclock) * 1E6 /
                                 (float(mode.htotal) * float(mode.vtotal)))
@@ -265,19 +565,77 @@ def parse_edid_data(edid):
     return vendor, model, modelines
 
 
-def collect_nvidia_data():
-    BusID_RE = re.compile((
-        r'(?P<domain>[0-9a-fA-F]+)'
-        r':'
-        r'(?P<bus>[0-9a-fA-F]+)'
-        r':'
-        r'(?P<device>[0-9a-fA-F]+)'
-        r'\.'
-        r'(?P<function>[0-9a-fA-F]+)'
-    ))
+def parse_edid_data(edid, parser='builtin'):
+    """return vendor, model and modelines for the raw EDID bytes"""
+    if parser == 'edid-decode':
+        return run_edid_decode(edid)
+    vendor, model, modelines = decode_edid(edid)
+    if parser == 'cross-check':
+        ref_vendor, ref_model, ref_modelines = run_edid_decode(edid)
+        ref_names = {m.split('"')[1] for m in ref_modelines}
+        missing = [m for m in modelines if m.split('"')[1] not in ref_names]
+        if (ref_vendor, ref_model) != (vendor, model) or missing:
+            module.warn("edid-decode disagrees: {} {} {} != {} {} {}".format(
+                ref_vendor, ref_model, sorted(ref_names),
+                vendor, model, [m.split('"')[1] for m in modelines]))
+    return vendor, model, modelines
+
+
+def pci_slot(bus_id):
+    """normalize a PCI address "domain:bus:device.function" (in hex) to the notation of sysfs"""
+    match = PCI_ADDRESS_REGEX.search(bus_id)
+    if not match:
+        return None
+    domain, bus, device, function = (int(n, 16) for n in match.groups())
+    return "{:04x}:{:02x}:{:02x}.{:x}".format(domain, bus, device, function)
+
+
+def xorg_bus_id(slot):
+    """convert a PCI slot to the BusID notation of xorg.conf"""
+    domain, bus, device, function = (int(n, 16) for n in PCI_ADDRESS_REGEX.search(slot).groups())
+    return "PCI:{:d}@{:d}:{:d}:{:d}".format(bus, domain, device, function)
+
+
+def nvidia_pci_slots():
+    """return the PCI slots of all nvidia display controllers (one uevent read per device)"""
+    slots = []
+    for uevent in glob(os.path.join(PCI_SYSFS, '*', 'uevent')):
+        try:
+            with open(uevent) as f:
+                data = dict(line.rstrip('\n').split('=', 1) for line in f if '=' in line)
+        except IOError:
+            continue
+        vendor_id = data.get('PCI_ID', '').partition(':')[0]
+        if vendor_id.lower() == NVIDIA_VENDOR_ID and data.get('PCI_CLASS', '').zfill(6).startswith(DISPLAY_CLASS):
+            slots.append(pci_slot(data.get('PCI_SLOT_NAME', '')))
+    return slots
+
+
+def read_nvidia_proc():
+    """return the model names of the GPUs known to the nvidia driver by their PCI slot"""
+    gpus = {}
+    for info_file in glob(os.path.join(NVIDIA_PROC, '*', 'information')):
+        info = {}
+        try:
+            with open(info_file) as f:
+                for line in f:
+                    key, sep, value = line.partition(':')
+                    if sep:
+                        info[key.strip()] = value.strip()
+        except IOError:
+            continue
+        slot = pci_slot(info.get('Bus Location', os.path.basename(os.path.dirname(info_file))))
+        if slot:
+            gpus[slot] = info.get('Model', 'Unknown')
+    return gpus
+
+
+def query_nvidia_smi():
+    """return the names of all GPUs nvidia-smi reports by their PCI slot"""
+    gpus = {}
     try:
         data = subprocess.check_output(["nvidia-smi", "--query-gpu=name,pci.bus_id",
-                                        "--format=csv", "-i0"], universal_newlines=True)
+                                        "--format=csv"], universal_newlines=True)
     except subprocess.CalledProcessError:
         pass
     except OSError:
@@ -285,15 +643,241 @@ def collect_nvidia_data():
         pass
     else:
         for row in csv.DictReader(data.splitlines(), delimiter=',', skipinitialspace=True):
-            name = row['name']
-            bus_id = row['pci.bus_id']
             # pci.bus_id structure as reported by nvidia-smi: "domain:bus:device.function", in hex.
-            match = BusID_RE.search(bus_id)
-            if match:
-                domain, bus, device, function = (int(n, 16) for n in match.groups())
-                bus_id = "PCI:{:d}@{:d}:{:d}:{:d}".format(bus, domain, device, function)
-                return name, bus_id
-    raise ValueError
+            slot = pci_slot(row['pci.bus_id'])
+            if slot:
+                gpus[slot] = row['name']
+    return gpus
+
+
+def find_nvidia_gpus():
+    """
+    return the name, PCI slot and xorg BusID of all GPUs driven by the nvidia driver, sorted by their slot,
+    and whether all nvidia display controllers have been found.
+    The names are read from /proc/driver/nvidia, nvidia-smi is only called if there
+    are nvidia display controllers in the PCI sysfs which are missing there.
+    """
+    gpus = read_nvidia_proc()
+    slots = nvidia_pci_slots()
+    if any(slot not in gpus for slot in slots):
+        gpus.update(query_nvidia_smi())
+    # e.g. if nouveau is still loaded the result will change after loading the nvidia driver
+    complete = all(slot in gpus for slot in slots)
+    return [{'name': name, 'slot': slot, 'bus_id': xorg_bus_id(slot)}
+            for slot, name in sorted(gpus.items())], complete
+
+
+def boot_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def nvidia_gpus(cache_file=None):
+    """return the GPUs found by find_nvidia_gpus, a complete result is cached until the next boot"""
+    current_boot = boot_id()
+    if cache_file and current_boot:
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached.get('boot_id') == current_boot:
+                return cached['gpus']
+        except (IOError, ValueError, KeyError, AttributeError):
+            pass
+    gpus, complete = find_nvidia_gpus()
+    if cache_file and current_boot and complete:
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp_file = cache_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump({'boot_id': current_boot, 'gpus': gpus}, f)
+            os.replace(tmp_file, cache_file)
+        except (IOError, OSError) as e:
+            module.warn("could not write cache file {}: {}".format(cache_file, e))
+    return gpus
+
+
+def read_edid_bytes(edid_file):
+    edid_bytes = b''
+    try:
+        with open(edid_file, 'rb') as f:
+            edid_bytes = f.read()
+    except IOError:
+        pass
+    return edid_bytes
+
+
+def write_edid(edid_file, edid, digest):
+    """replace edid_file atomically unless its sha256 matches the digest, returns True if it was written"""
+    if hashlib.sha256(read_edid_bytes(edid_file)).hexdigest() == digest:
+        return False
+    tmp_file = edid_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(edid)
+    os.replace(tmp_file, edid_file)
+    return True
+
+
+def update_edid_files(data):
+    """write the EDIDs of all connectors of the xrandr data, returns True if a file changed"""
+    changed = False
+    for screen_data in data.values():
+        for connector, connection_data in screen_data.items():
+            if connection_data.get('EDID'):
+                edid = binascii.a2b_hex(connection_data['EDID'])
+                digest = connection_data.get('edid_sha256') or hashlib.sha256(edid).hexdigest()
+                changed |= write_edid(EDID_FILE.format(connector), edid, digest)
+    return changed
+
+
+def drm_card_info(card_dir):
+    """return the device (e.g. the PCI slot), its subsystem and driver of a drm card"""
+    info = {}
+    for key, link in (('device', 'device'), ('subsystem', 'device/subsystem'), ('driver', 'device/driver')):
+        path = os.path.join(card_dir, link)
+        if os.path.exists(path):
+            info[key] = os.path.basename(os.path.realpath(path))
+    return info
+
+
+def drm_connector_index():
+    """
+    read the connectors of all drm cards, returns a dict with the data of each connector
+    by its sysfs name (e.g. card1-HDMI-A-1) and a dict which maps the sha256 of the EDIDs
+    of the connected displays to the names of their connectors
+    """
+    connectors = {}
+    by_edid = {}
+    cards = {}
+    for connector_dir in sorted(glob(os.path.join(DRM_SYSFS, 'card*-*'))):
+        name = os.path.basename(connector_dir)
+        match = DRM_CONNECTOR_REGEX.match(name)
+        if not match:
+            continue
+        try:
+            with open(os.path.join(connector_dir, 'status')) as f:
+                status = f.read().strip()
+        except IOError:
+            continue
+        card = match.group('card')
+        if card not in cards:
+            cards[card] = drm_card_info(os.path.join(DRM_SYSFS, card))
+        connector = dict(cards[card], card=card, drm_connector=match.group('connector'),
+                         status=status, edid_sha256=None)
+        if status == 'connected':
+            connector['edid_sha256'] = hashlib.sha256(
+                read_edid_bytes(os.path.join(connector_dir, 'edid'))).hexdigest()
+            by_edid.setdefault(connector['edid_sha256'], []).append(name)
+        connectors[name] = connector
+    return connectors, by_edid
+
+
+def xrandr_connector_name(drm_connector, driver=None):
+    """
+    return the name of the X output for a drm connector: the modesetting driver
+    calls HDMI-A-1 HDMI-1, amdgpu and radeon count from 0 and call it HDMI-A-0
+    """
+    connector_type, _, number = drm_connector.rpartition('-')
+    if not number.isdigit():
+        return drm_connector
+    if driver in ('amdgpu', 'radeon'):
+        return '{}-{}'.format(AMDGPU_CONNECTOR_TYPES.get(connector_type, connector_type), int(number) - 1)
+    return '{}-{}'.format(MODESETTING_CONNECTOR_TYPES.get(connector_type, connector_type), number)
+
+
+def read_sysfs_lines(path):
+    try:
+        with open(path) as f:
+            return f.read().split()
+    except IOError:
+        return []
+
+
+def read_drm_outputs():
+    """
+    build the data parse_xrandr_verbose returns from the drm subsystem: the resolutions
+    come from the modes the kernel accepts (the first one is the preferred mode), the refresh
+    rates and modelines from the timings in the EDID. All connectors are put into "Screen 0:",
+    a name which is already taken by a connector of another card gets the card number appended.
+    Returns an empty dict if no display is connected.
+    """
+    outputs = {}
+    connectors, by_edid = drm_connector_index()
+    if not by_edid:
+        return {}
+    for drm_name, connector in connectors.items():
+        connector_dir = os.path.join(DRM_SYSFS, drm_name)
+        name = xrandr_connector_name(connector['drm_connector'], connector.get('driver'))
+        if name in outputs:
+            # the same connector on another card
+            name = '{}-{}'.format(name, connector['card'][len('card'):])
+        output = outputs[name] = {
+            "is_connected": connector['status'] == 'connected',
+            "EDID": "",
+            "modes": {},
+            "modelines": {},
+            "preferred": "",
+            "current": "",
+            "auto": "",
+        }
+        if not output["is_connected"]:
+            continue
+        output["enabled"] = read_sysfs_lines(os.path.join(connector_dir, 'enabled')) == ['enabled']
+        edid = read_edid_bytes(os.path.join(connector_dir, 'edid'))
+        output["EDID"] = binascii.b2a_hex(edid).decode()
+        kernel_modes = read_sysfs_lines(os.path.join(connector_dir, 'modes'))
+        for timing in edid_timings(edid):
+            # like the xrandr parser ignore interlaced modes
+            if timing.interlaced or (kernel_modes and timing.resolution not in kernel_modes):
+                continue
+            rrates = output["modes"].setdefault(timing.resolution, [])
+            if timing.refreshrate not in rrates:
+                rrates.append(timing.refreshrate)
+            mode_name = '{}_{}'.format(timing.resolution, timing.refreshrate)
+            if timing.timings:
+                output["modelines"].setdefault(mode_name, 'Modeline "{}"  {}'.format(mode_name, timing.timings))
+            if not output["preferred"] and (not kernel_modes or timing.resolution == kernel_modes[0]):
+                output["preferred"] = mode_name
+    return {"Screen 0:": outputs}
+
+
+def display_profile_key(params):
+    """
+    hash the EDIDs of the connected displays and the preferences, the backend
+    and the EDID parser which influence the results, returns None if there are no KMS connectors
+    """
+    _, by_edid = drm_connector_index()
+    if not by_edid:
+        return None
+    profile = {
+        'edids': sorted((name, digest) for digest, names in by_edid.items() for name in names),
+        'params': [params[p] for p in ('preferred_outputs', 'preferred_refreshrates', 'preferred_resolutions',
+                                       'backend', 'edid_parser')],
+    }
+    return hashlib.sha256(json.dumps(profile, sort_keys=True).encode()).hexdigest()
+
+
+def load_display_profiles(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def store_display_profile(cache_file, key, facts):
+    profiles = load_display_profiles(cache_file)
+    profiles.pop(key, None)
+    profiles[key] = facts
+    # keep the most recently used profiles
+    profiles = dict(list(profiles.items())[-CACHED_PROFILES:])
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(profiles, f)
+    os.replace(tmp_file, cache_file)
 
 
 def find_drm_connectors(connections):
@@ -304,83 +888,93 @@ def find_drm_connectors(connections):
             'edid': 'edid.HDMI-1.bin',
             'drm_connector': 'HDMI-A-1',
             'xrandr_connector': 'HDMI-1',
+            'card': 'card0',
+            'device': '0000:00:02.0',
         },
         'secondary': {
             'edid': 'edid.eDP-1.bin',
             'drm_connector': 'eDP-1',
             'xrandr_connector': 'eDP-1',
+            'card': 'card0',
+            'device': '0000:00:02.0',
+        }
+        'ignored_outputs': ['HDMI-A-2', 'DP-1'],  # bare names, without those of primary and secondary
+        'connectors': {
+            'card0-HDMI-A-1': {
+                'card': 'card0',
+                'drm_connector': 'HDMI-A-1',
+                'status': 'connected',
+                'edid_sha256': '93261ec1...',
+                'device': '0000:00:02.0',
+                'subsystem': 'pci',
+                'driver': 'i915',
+            },
+            ...
         }
-        'ignored_outputs': ['HDMI-A-2', 'DP-1']
     }
+    The displays are matched by the sha256 of their EDID on all drm cards.
     """
-    STATUS_GLOB = '/sys/class/drm/card0*/status'
-    CONNECTOR_RE = re.compile('card0-(?P<connector>[^/]+)/status')
-
-    def read_edid_bytes(edid_file):
-        edid_bytes = b''
-        try:
-            with open(edid_file, 'rb') as f:
-                edid_bytes = f.read()
-        except IOError:
-            pass
-        return edid_bytes
-
-    xrandr_edid_bytes = read_edid_bytes(connections.get('primary', {}).get('edid', ""))
-    secondary_xrandr_edid_bytes = read_edid_bytes(connections.get('secondary', {}).get('edid', ''))
-
-    drm = {'primary': {}, 'secondary': {}, 'ignored_outputs': []}
-    for status_p in glob(STATUS_GLOB):
-        match = re.search(CONNECTOR_RE, status_p)
-        if match:
-            drm_connector = match.group('connector')
-        else:
+    connectors, by_edid = drm_connector_index()
+    drm = {'primary': {}, 'secondary': {}, 'ignored_outputs': [], 'connectors': connectors}
+    matched = set()
+    for name in ('primary', 'secondary'):
+        connection = connections.get(name)
+        if not connection:
             continue
-
-        try:
-            with open(status_p) as f:
-                connected = f.read().strip() == 'connected'
-        except IOError:
+        digest = connection.get('edid_sha256')
+        if digest is None:
+            edid = read_edid_bytes(connection.get('edid', ''))
+            digest = hashlib.sha256(edid).hexdigest() if edid else None
+        # identical displays have the same EDID, take the first connector which is still unused
+        drm_name = next((c for c in by_edid.get(digest, ()) if c not in matched), None)
+        if drm_name is None:
             continue
-
-        if connected:
-            edid = read_edid_bytes(os.path.join(
-                os.path.dirname(status_p), 'edid'))
-            if edid:
-                if edid == xrandr_edid_bytes:
-                    drm['primary'] = {
-                        'edid': os.path.basename(connections['primary'].get('edid', "")),
-                        'drm_connector': drm_connector,
-                        'xrandr_connector': connections['primary'].get('connector',''),
-                    }
-                    continue
-                if secondary_xrandr_edid_bytes:
-                    drm['secondary'] = {
-                        'edid': os.path.basename(connections.get('secondary').get('edid', '')),
-                        'drm_connector': drm_connector,
-                        'xrandr_connector': connections['secondary'].get('connector',''),
-                    }
-                    continue
-        drm['ignored_outputs'].append(drm_connector)
+        matched.add(drm_name)
+        connector = connectors[drm_name]
+        drm[name] = {
+            'edid': os.path.basename(connection.get('edid', '')),
+            'drm_connector': connector['drm_connector'],
+            'xrandr_connector': connection.get('connector', ''),
+            'card': connector['card'],
+        }
+        if 'device' in connector:
+            drm[name]['device'] = connector['device']
+    # video=<connector>:d on the kernel command line doesn't know about cards,
+    # so a name which is used by a matched display must never be ignored
+    used_names = {connectors[c]['drm_connector'] for c in matched}
+    for drm_name, connector in connectors.items():
+        name = connector['drm_connector']
+        if drm_name not in matched and name not in used_names and name not in drm['ignored_outputs']:
+            drm['ignored_outputs'].append(name)
     return drm
 
 
-def output_data(data, write_edids=True):
+def output_data(data, write_edids=True, cache_file=None, profile_key=None, gpu_cache_file=None):
     result = {}
     drm = {}
+    changed = False
     if data:
         modes = []
+        edids = {}
+        digests = {}
         for _, screen_data in data.items():
             for connector, connection_data in screen_data.items():
-                if connection_data.get('EDID') and write_edids:
-                    with open('/etc/X11/edid.{}.bin'.format(connector), 'wb') as edid:
-                        edid.write(binascii.a2b_hex(connection_data['EDID']))
+                if connection_data.get('EDID'):
+                    edids[connector] = binascii.a2b_hex(connection_data['EDID'])
+                    digests[connector] = hashlib.sha256(edids[connector]).hexdigest()
+                    connection_data['edid_sha256'] = digests[connector]
                 for resolution, refreshrates in connection_data['modes'].items():
                     for refreshrate in refreshrates:
                         modes.append(Mode(connector, resolution, refreshrate))
+        if write_edids:
+            changed = update_edid_files(data)
         if modes:
-            try:
-                gpu_name, bus_id = collect_nvidia_data()
-            except ValueError:
+            gpus = nvidia_gpus(gpu_cache_file)
+            if gpus:
+                result['nvidia_gpus'] = gpus
+                gpu_name = gpus[0]['name']
+                bus_id = gpus[0]['bus_id']
+            else:
                 gpu_name = None
                 bus_id = None
 
@@ -389,7 +983,8 @@ def output_data(data, write_edids=True):
                     'connector': connector,
                     'resolution': resolution,
                     'refreshrate': refreshrate,
-                    'edid': '/etc/X11/edid.{}.bin'.format(connector),
+                    'edid': EDID_FILE.format(connector),
+                    'edid_sha256': digests.get(connector),
                     'mode': "{}_{}".format(resolution, refreshrate),
                     'vendor': vendor,
                     'model': model,
@@ -399,36 +994,77 @@ def output_data(data, write_edids=True):
                     result[name]['gpu_name'] = gpu_name
                     result[name]['bus_id'] = bus_id
 
-            connector_0, resolution_0, refreshrate_0 = max(modes, key=sort_mode)[:3]
-            connector_0_edid = '/etc/X11/edid.{}.bin'.format(connector_0)
-            vendor_0, model_0, modelines_0 = parse_edid_data(connector_0_edid)
+            score_mode = mode_ranking(module.params['preferred_refreshrates'],
+                                      module.params['preferred_resolutions'],
+                                      module.params['preferred_outputs'])
+            candidates = rank_modes(modes, score_mode)
+
+            connector_0 = best_connector(candidates, score_mode)
+            _, resolution_0, refreshrate_0 = candidates[connector_0][0]
+            vendor_0, model_0, modelines_0 = parse_edid_data(
+                edids.get(connector_0, b''), module.params['edid_parser'])
             create_entry(result, 'primary', connector_0, resolution_0,
                          refreshrate_0, vendor_0, model_0, modelines_0)
 
             # check if additional monitors exist
-            other_modes = [mode for mode in modes if mode[0] != connector_0]
-            if other_modes:
-                connector_1, resolution_1, refreshrate_1 = max(other_modes, key=sort_mode)[:3]
-                connector_1_edid = '/etc/X11/edid.{}.bin'.format(connector_1)
-                vendor_1, model_1, modelines_1 = parse_edid_data(connector_1_edid)
+            connector_1 = best_connector(candidates, score_mode, exclude=(connector_0,))
+            if connector_1:
+                _, resolution_1, refreshrate_1 = candidates[connector_1][0]
+                vendor_1, model_1, modelines_1 = parse_edid_data(
+                    edids.get(connector_1, b''), module.params['edid_parser'])
                 create_entry(result, 'secondary', connector_1, resolution_1,
                              refreshrate_1, vendor_1, model_1, modelines_1)
 
+            # all modes of each connector from the best to the worst choice
+            result['candidates'] = {
+                connector: [{'resolution': resolution, 'refreshrate': refreshrate,
+                             'mode': "{}_{}".format(resolution, refreshrate)}
+                            for _, resolution, refreshrate in connector_modes]
+                for connector, connector_modes in candidates.items()
+            }
+
             if write_edids:
                 drm = find_drm_connectors(result)
 
 
-    module.exit_json(changed=True if write_edids else False,
-                     ansible_facts={'xrandr': data, 'xorg': result, 'drm': drm})
+    facts = {'xrandr': data, 'xorg': result, 'drm': drm}
+    if cache_file and profile_key and result:
+        try:
+            store_display_profile(cache_file, profile_key, facts)
+        except (IOError, OSError) as e:
+            module.warn("could not write cache file {}: {}".format(cache_file, e))
+
+    module.exit_json(changed=changed, cached=False, ansible_facts=facts)
 
 
 if __name__ == '__main__':
     module = AnsibleModule(argument_spec=ARG_SPECS, supports_check_mode=False,)
-    try:
-        d = subprocess.check_output(['xrandr', '-d', module.params['display'], '--verbose'],
-                                    errors='replace', universal_newlines=True).splitlines()
-    except subprocess.CalledProcessError:
-        xorg_data = {}
+    cache_mode = module.params['cache']
+    cache_file = os.path.join(module.params['cache_dir'], 'xrandr_facts.cache')
+    # the GPUs don't change until the next boot, so this cache doesn't depend on the cache option
+    gpu_cache_file = os.path.join(module.params['cache_dir'], 'xrandr_facts.gpus.cache')
+    profile_key = None
+    if cache_mode != 'off':
+        profile_key = display_profile_key(module.params)
+        if cache_mode in ('use', 'lookup') and profile_key:
+            profile = load_display_profiles(cache_file).get(profile_key)
+            if profile is not None:
+                # the EDID files may have been removed or replaced since the profile was stored
+                changed = module.params['write_edids'] and update_edid_files(profile['xrandr'])
+                module.exit_json(changed=changed, cached=True, ansible_facts=profile)
+        if cache_mode == 'lookup':
+            module.exit_json(changed=False, cached=False)
+    if module.params['backend'] == 'drm':
+        xorg_data = read_drm_outputs()
     else:
-        xorg_data = parse_xrandr_verbose(iter(d))
-    output_data(xorg_data, module.params['write_edids'])
+        try:
+            with subprocess.Popen(['xrandr', '-d', module.params['display'], '--verbose'],
+                                  stdout=subprocess.PIPE, errors='replace',
+                                  universal_newlines=True) as xrandr:
+                xorg_data = parse_xrandr_verbose(xrandr.stdout)
+        except OSError:
+            xorg_data = {}
+        else:
+            if xrandr.returncode != 0:
+                xorg_data = {}
+    output_data(xorg_data, module.params['write_edids'], cache_file, profile_key, gpu_cache_file)
@@ -1,20 +1,24 @@
 #!/usr/bin/env python3
-import copy
+import os
 import sys
+import tempfile
 from pathlib import Path
 from typing import List, IO, Any, Optional
 import ruamel.yaml
+from ruamel.yaml.comments import CommentedMap
 from ansible.module_utils.basic import AnsibleModule
 
 
 DOCUMENTATION = '''
 ---
 module: yaml_edit
-short_description: "change the value of a key in a yaml file"
+short_description: "change the value of one or more keys in a yaml file"
 description:
      - This module changes the value of a given key (if nested in the form 'a.b.c')
        to the given value and type (choose one of the <type>_value arguments). You can set formatting options to get the desired
        layout, so the change is non-intrusive.
+     - Multiple keys can be changed at once with the edits argument, the file is loaded once and
+       written (atomically) only if a value has changed.
 options:
     path: 
         required: True
@@ -23,10 +27,18 @@ options:
             - the path of the yaml file you want to edit
     
     key:
-        required: True
+        required: False
         type: str
         description:
             - the key you want to change. Nested keys can be specified in dot notation, e.g. 'a.b.c'
+            - either key and one of the <type>_value arguments or edits is required
+
+    edits:
+        required: False
+        type: list
+        elements: dict
+        description:
+            - a list of changes, each one with a key and one of the <type>_value arguments
 
     str_value:
         required: False
@@ -58,7 +70,7 @@ options:
         description:
             - set a float value
 
-    float_value:
+    dict_value:
         required: False
         type: dict
         description:
@@ -114,10 +126,28 @@ EXAMPLES = '''
     path: /etc/yavdr-frontend/config.yml
     key: vdr.id
     int_value: "{{ vdr.instance_id }}"
+
+- name: set vdr instance id and attach behaviour for yavdr-frontend
+  yaml_edit:
+    path: /etc/yavdr-frontend/config.yml
+    edits:
+      - key: vdr.id
+        int_value: "{{ vdr.instance_id }}"
+      - key: vdr.attach_on_startup
+        str_value: auto
 '''
 
 debug_output = []
 
+VALUE_ARGS = dict(
+    str_value=dict(type='str'),
+    int_value=dict(type='int'),
+    bool_value=dict(type='bool'),
+    list_value=dict(type='list'),
+    float_value=dict(type='float'),
+    dict_value=dict(type='dict'),
+)
+
 
 class yamlInPlaceEditor():
     def __init__(
@@ -147,46 +177,61 @@ class yamlInPlaceEditor():
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
-        if self.changed:
+        if self.changed and exc_type is None:
             self.dump_file(self.filename)
 
     def set_dict_value(self, key: str, value: Any) -> None:
-        d = copy.deepcopy(self.data)
-        w = d
+        w = self.data
         parts = key.split('.')
         debug_output.append(f"called set_dict_value with {key=}, {value=}")
-        debug_output.append(f"{type(self.data)=}: {self.data}")
         for p in parts[:-1]:  # the last part of the key is the value we want to change
-            if not (t := w.get(p)):
-                w[p] = dict()
+            if not isinstance(w.get(p), dict):
+                w[p] = CommentedMap()
                 self.changed = True
-            else:
-                w = t
-        if w[parts[-1]] != value:
+            w = w[p]
+        if parts[-1] not in w or w[parts[-1]] != value:
+            w[parts[-1]] = value
             self.changed = True
-        w[parts[-1]] = value
-        self.data.update(d)
-        print(f"{self.changed=}")
 
     def load_file(self, fd: IO) -> None:
         self.data = self.yaml.load(fd)
+        if self.data is None:
+            self.data = CommentedMap()
 
-    def dump_file(self, fd: IO = sys.stdout):
-        self.yaml.dump(self.data, fd)
+    def dump_file(self, filename: Path) -> None:
+        """write to a temporary file and replace the original one, so readers never see a partial file"""
+        fd, tmp_name = tempfile.mkstemp(dir=filename.parent, prefix=f".{filename.name}.")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                self.yaml.dump(self.data, f)
+            st = filename.stat()
+            os.chmod(tmp_name, st.st_mode)
+            os.chown(tmp_name, st.st_uid, st.st_gid)
+            os.replace(tmp_name, filename)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+
+def get_value(params: dict) -> Any:
+    """return the value of the first (and only) <type>_value argument which is set"""
+    for k in VALUE_ARGS:
+        if params.get(k) is not None:
+            return params[k]
+    raise ValueError(f"no value given for key {params.get('key')}")
 
 
 def run_module():
     changed = False
     module_args = dict(
         path=dict(type='path', required=True),
-        key=dict(type='str', required=True),
-        str_value=dict(type='str'),
-        int_value=dict(type='int'),
-        bool_value=dict(type='bool'),
-        list_value=dict(type='list'),
-        float_value=dict(type='float'),
-        dict_value=dict(type='dict'),
-        
+        key=dict(type='str'),
+        edits=dict(type='list', elements='dict', options=dict(
+            key=dict(type='str', required=True),
+            **VALUE_ARGS,
+        )),
+        **VALUE_ARGS,
+
         preserve_quotes=dict(type='bool', default=True),
         explicit_start=dict(type='bool', default=True),
         boolean_representation=dict(type='list', elements='str', default=[]),
@@ -196,18 +241,15 @@ def run_module():
     )
     module = AnsibleModule(
         module_args,
-        required_one_of=[[
-            'str_value',
-            'int_value',
-            'bool_value',
-            'list_value',
-            'float_value',
-            'json_value',
-            'dict_value',
-        ]],
+        required_one_of=[['key', 'edits']],
+        mutually_exclusive=[['key', 'edits']],
         supports_check_mode=False,
     )
     try:
+        if module.params['edits']:
+            edits = [(edit['key'], get_value(edit)) for edit in module.params['edits']]
+        else:
+            edits = [(module.params['key'], get_value(module.params))]
         with yamlInPlaceEditor(
                 filename=module.params['path'],
                 preserve_quotes=module.params['preserve_quotes'],
@@ -217,12 +259,8 @@ def run_module():
                 sequence_indent=module.params['sequence_indent'],
                 offset_indent=module.params['offset_indent'],
            ) as e:
-            for k, v in module.params.items():
-                if not k.endswith('_value'):
-                    continue
-                if v is not None:  # only one of the *_value variables must be not None
-                    e.set_dict_value(module.params['key'], v)
-                    break
+            for key, value in edits:
+                e.set_dict_value(key, value)
             changed = e.changed or changed
     except Exception as err:
         changed = False
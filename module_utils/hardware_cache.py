@@ -0,0 +1,60 @@
+# This module_utils file provides the hardware fingerprint and the fact cache
+# shared by the hardware_facts and pci_facts modules.
+import hashlib
+import json
+import os
+
+
+def read_module_names(proc_modules='/proc/modules'):
+    try:
+        with open(proc_modules) as f:
+            return [line.split(None, 1)[0] for line in f if line.strip()]
+    except IOError:
+        return []
+
+def hardware_fingerprint():
+    """
+    a cheap fingerprint of the hardware state: a stat() sweep over the
+    pci and usb device links, the names of the loaded kernel modules,
+    the running kernel and the boot id
+    """
+    def stat_sweep(path):
+        try:
+            return sorted((e.name, e.stat(follow_symlinks=False).st_mtime) for e in os.scandir(path))
+        except OSError:
+            return []
+
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            boot_id = f.read().strip()
+    except IOError:
+        boot_id = None
+    fingerprint = {
+        'kernel': os.uname().release,
+        'boot_id': boot_id,
+        'pci': stat_sweep('/sys/bus/pci/devices'),
+        'usb': stat_sweep('/sys/bus/usb/devices'),
+        'modules': read_module_names(),
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+def load_cache(cache_file, fingerprint, params):
+    """
+    return the cached facts if they were collected with the same module
+    params for the same hardware fingerprint, None otherwise
+    """
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if cache.get('fingerprint') == fingerprint and cache.get('params') == params:
+        return cache.get('facts')
+    return None
+
+def store_cache(cache_file, fingerprint, params, facts):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'params': params, 'facts': facts}, f)
+    os.replace(tmp_file, cache_file)
@@ -18,10 +18,133 @@ Installation:
 
 callback_plugins = plugins/callbacks
 callback_whitelist = auto_tags
+
+Profiling:
+The plugin can also measure the wall clock time of each role, task and handler. This is
+disabled by default, enable it for a single run with
+
+AUTO_TAGS_PROFILE=1 ansible-playbook yavdr07.yml
+
+At the end of the playbook a summary of the slowest tasks and the time per role is shown.
+Tasks which spend most of their time in a fixed sleep (wait_for with a timeout but nothing
+to wait for, pause) are flagged. Set AUTO_TAGS_PROFILE_REPORT to a file name ending in
+.json or .csv to get a machine readable report.
+
+Tag index:
+Before a partial run it is useful to know what a tag selection will actually do. With
+
+AUTO_TAGS_INDEX=1 ansible-playbook --tags=vdr yavdr07.yml
+
+the plugin prints which roles carry each tag and how many tasks of each role the given
+--tags/--skip-tags selection runs. Tasks which only run because they are tagged `always`
+are listed in a warning. Tasks pulled in by include_tasks/include_role are not expanded.
 """
 from __future__ import print_function
+
+import csv
+import json
+import time
+from collections import OrderedDict
+
+from ansible.playbook.block import Block
 from ansible.plugins.callback import CallbackBase
 
+try:
+    from ansible import context
+except ImportError:
+    # Ansible < 2.8
+    context = None
+
+DOCUMENTATION = '''
+    callback: auto_tags
+    type: aggregate
+    short_description: adds a tag for each role, optionally profiles roles and tasks
+    description:
+      - Adds a tag with the name of the role to every role.
+      - Optionally measures the wall clock time of roles, tasks and handlers.
+      - Optionally shows which roles and tasks a --tags/--skip-tags selection runs.
+    options:
+      tag_index:
+        description: show the roles of each tag and the tasks selected by --tags and --skip-tags
+        default: False
+        type: bool
+        env:
+          - name: AUTO_TAGS_INDEX
+        ini:
+          - section: callback_auto_tags
+            key: tag_index
+      profile:
+        description: measure the time of each role, task and handler
+        default: False
+        type: bool
+        env:
+          - name: AUTO_TAGS_PROFILE
+        ini:
+          - section: callback_auto_tags
+            key: profile
+      profile_report:
+        description: write the profile to this file, the format (json or csv) is chosen by the extension
+        default: null
+        type: path
+        env:
+          - name: AUTO_TAGS_PROFILE_REPORT
+        ini:
+          - section: callback_auto_tags
+            key: profile_report
+      profile_task_count:
+        description: number of tasks shown in the summary
+        default: 20
+        type: int
+        env:
+          - name: AUTO_TAGS_PROFILE_TASK_COUNT
+        ini:
+          - section: callback_auto_tags
+            key: profile_task_count
+'''
+
+# modules which just sleep for a fixed time
+SLEEP_ACTIONS = ('pause', 'ansible.builtin.pause')
+WAIT_FOR_ACTIONS = ('wait_for', 'ansible.builtin.wait_for')
+WAIT_FOR_CONDITIONS = ('host', 'port', 'path', 'search_regex', 'active_connection_states')
+# modules which don't do any work on the target
+CHEAP_ACTIONS = tuple(prefix + action for prefix in ('', 'ansible.builtin.')
+                      for action in ('set_fact', 'debug', 'include_vars', 'meta', 'assert', 'fail'))
+
+
+def selected_tags():
+    """return the --tags and --skip-tags of the current run"""
+    if context is None:
+        return frozenset(['all']), frozenset()
+    only_tags = frozenset(t for tags in context.CLIARGS.get('tags') or () for t in tags.split(',') if t)
+    skip_tags = frozenset(t for tags in context.CLIARGS.get('skip_tags') or () for t in tags.split(',') if t)
+    return only_tags or frozenset(['all']), skip_tags
+
+
+def should_run(tags, only_tags, skip_tags):
+    """the same rules as Taggable.evaluate_tags, without templating"""
+    tags = frozenset(tags) or frozenset(['untagged'])
+    tagged = tags != frozenset(['untagged'])
+    run = ('always' in tags
+           or ('all' in only_tags and 'never' not in tags)
+           or not tags.isdisjoint(only_tags)
+           or ('tagged' in only_tags and tagged and 'never' not in tags))
+    if run and skip_tags:
+        if 'all' in skip_tags:
+            run = 'always' in tags and 'always' not in skip_tags
+        elif not tags.isdisjoint(skip_tags) or ('tagged' in skip_tags and tagged):
+            run = False
+    return run
+
+
+def iter_tasks(blocks):
+    for block in blocks:
+        for task in block.block + block.rescue + block.always:
+            if isinstance(task, Block):
+                for t in iter_tasks([task]):
+                    yield t
+            else:
+                yield task
+
 
 class CallbackModule(CallbackBase):
     """
@@ -29,6 +152,21 @@ class CallbackModule(CallbackBase):
     it seemed the best choice for our use case, because it allows you to hook into the start
     of a playbook.
     """
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'auto_tags'
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        self.profile = False
+        self.timings = OrderedDict()
+        self.current = None
+
+    def set_options(self, *args, **kwargs):
+        super(CallbackModule, self).set_options(*args, **kwargs)
+        self.profile = self.get_option('profile')
+
     def v2_playbook_on_start(self, playbook):
         """
         Dynamically add a tag of the same name to each role.
@@ -46,3 +184,160 @@ class CallbackModule(CallbackBase):
             role_name = role._role_name
             if role_name not in role.tags:
                 role.tags += [role_name]
+
+        if self.get_option('tag_index'):
+            self.show_tag_index(plays)
+
+    # ---- tag index ----
+    def build_tag_index(self, plays):
+        """
+        Compile each role once and return a tag -> roles index and a role -> tasks map.
+        Roles used in several plays are only listed once, the tasks of dependencies
+        which are inlined into several roles are counted once like ansible runs them.
+        """
+        index = OrderedDict()
+        tasks = OrderedDict()
+        seen = set()
+        for play in plays:
+            for role in play.get_roles():
+                if role._role_name in tasks:
+                    continue
+                tasks[role._role_name] = []
+                for task in iter_tasks(role.compile(play=play)):
+                    if task._uuid in seen:
+                        continue
+                    seen.add(task._uuid)
+                    role_name = task._role._role_name if task._role else role._role_name
+                    tasks.setdefault(role_name, []).append(task)
+                    for tag in task.tags:
+                        index.setdefault(tag, OrderedDict())[role_name] = True
+        return OrderedDict((tag, list(roles)) for tag, roles in index.items()), tasks
+
+    def show_tag_index(self, plays):
+        only_tags, skip_tags = selected_tags()
+        index, tasks = self.build_tag_index(plays)
+
+        self._display.banner("TAG INDEX")
+        for tag in sorted(index):
+            self._display.display("{}: {}".format(tag, ', '.join(index[tag])))
+
+        self._display.banner("TAG SELECTION: --tags {} --skip-tags {}".format(
+            ','.join(sorted(only_tags)), ','.join(sorted(skip_tags)) or '-'))
+        forced = []
+        for role_name, role_tasks in tasks.items():
+            selected = [t for t in role_tasks if should_run(t.tags, only_tags, skip_tags)]
+            if not selected:
+                continue
+            self._display.display("{}: {} of {} tasks".format(role_name, len(selected), len(role_tasks)))
+            for task in selected:
+                self._display.vv("    {}".format(task.get_name()))
+                if ('always' in task.tags and task.action not in CHEAP_ACTIONS
+                        and not should_run(set(task.tags) - {'always'}, only_tags, skip_tags)):
+                    forced.append("{} : {} ({})".format(role_name, task.get_name(), task.action))
+        if forced and 'all' not in only_tags:
+            self._display.warning("these tasks are tagged 'always' and run in every targeted run:\n  "
+                                  + '\n  '.join(forced))
+
+    # ---- profiling ----
+    @staticmethod
+    def fixed_sleep(task):
+        """return the number of seconds a task sleeps unconditionally"""
+        args = task.args or {}
+        try:
+            if task.action in SLEEP_ACTIONS:
+                return float(args.get('seconds', 0)) + 60 * float(args.get('minutes', 0))
+            if task.action in WAIT_FOR_ACTIONS and not any(args.get(c) for c in WAIT_FOR_CONDITIONS):
+                return float(args.get('timeout', 0)) + float(args.get('delay', 0))
+        except (TypeError, ValueError):
+            # templated values can't be evaluated here
+            pass
+        return 0
+
+    def start_timing(self, task, kind):
+        now = time.time()
+        self.stop_timing(now)
+        role = task._role._role_name if task._role else ''
+        self.current = task._uuid
+        self.timings[task._uuid] = {
+            'kind': kind,
+            'role': role,
+            'name': task.get_name(),
+            'action': task.action,
+            'start': now,
+            'end': None,
+            'duration': 0.0,
+            'fixed_sleep': self.fixed_sleep(task),
+        }
+
+    def stop_timing(self, now=None):
+        if self.current is None:
+            return
+        timing = self.timings[self.current]
+        # the last result of a task marks its end, fall back to the start of the next task
+        end = timing['end'] or now or time.time()
+        timing['duration'] += end - timing['start']
+        self.current = None
+
+    def mark_result(self, result):
+        if self.profile and self.current == result._task._uuid:
+            self.timings[self.current]['end'] = time.time()
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        if self.profile:
+            self.start_timing(task, 'task')
+
+    def v2_playbook_on_handler_task_start(self, task):
+        if self.profile:
+            self.start_timing(task, 'handler')
+
+    def v2_runner_on_ok(self, result):
+        self.mark_result(result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.mark_result(result)
+
+    def v2_runner_on_skipped(self, result):
+        self.mark_result(result)
+
+    def v2_runner_on_unreachable(self, result):
+        self.mark_result(result)
+
+    def v2_playbook_on_stats(self, stats):
+        if not self.profile:
+            return
+        self.stop_timing()
+        timings = sorted(self.timings.values(), key=lambda t: t['duration'], reverse=True)
+        for timing in timings:
+            timing['sleep_dominated'] = timing['fixed_sleep'] > 0 and timing['fixed_sleep'] >= timing['duration'] / 2
+        roles = OrderedDict()
+        for timing in timings:
+            roles[timing['role']] = roles.get(timing['role'], 0) + timing['duration']
+        roles = OrderedDict(sorted(roles.items(), key=lambda r: r[1], reverse=True))
+
+        self._display.banner("PROFILE: TASKS AND HANDLERS")
+        for timing in timings[:self.get_option('profile_task_count')]:
+            self._display.display("{:>9.2f}s  {:<7} {}{}{}".format(
+                timing['duration'], timing['kind'],
+                timing['role'] + ' : ' if timing['role'] else '', timing['name'],
+                ' (fixed sleep of {:g}s)'.format(timing['fixed_sleep']) if timing['sleep_dominated'] else ''))
+        self._display.banner("PROFILE: ROLES")
+        for role, duration in roles.items():
+            self._display.display("{:>9.2f}s  {}".format(duration, role or '(playbook)'))
+
+        report = self.get_option('profile_report')
+        if report:
+            self.write_report(report, timings, roles)
+
+    def write_report(self, path, timings, roles):
+        fields = ('kind', 'role', 'name', 'action', 'start', 'duration', 'fixed_sleep', 'sleep_dominated')
+        try:
+            with open(path, 'w') as f:
+                if path.endswith('.csv'):
+                    writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+                    writer.writeheader()
+                    writer.writerows(timings)
+                else:
+                    json.dump({'roles': roles,
+                               'tasks': [{k: t[k] for k in fields} for t in timings]}, f, indent=2)
+        except IOError as e:
+            self._display.warning("could not write profile report {}: {}".format(path, e))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# time the xrandr --verbose parser of library/xrandr_facts.py on the dumps in
+# tests/xrandr_facts and on a synthetic large dump, which is built by repeating
+# the connectors of one of them (xrandr_output.8k by default) under new names, usage:
+#   python3 tests/benchmark_xrandr_facts.py [--copies N] [--repeat N] [dump]
+import argparse
+import os
+import re
+import sys
+import timeit
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIR = os.path.join(TEST_DIR, 'xrandr_facts')
+sys.path.insert(0, os.path.join(TEST_DIR, os.pardir, 'library'))
+
+import xrandr_facts  # noqa: E402
+
+
+def synthetic_dump(lines, copies):
+    """repeat all connector sections of the first screen with numbered connector names"""
+    screen = [line for line in lines if line.startswith('Screen')][:1]
+    body = [line for line in lines if not line.startswith('Screen')]
+    dump = list(screen)
+    for n in range(copies):
+        for line in body:
+            if not line[:1].isspace() and 'connected' in line:
+                line = re.sub(r'^(\S+)', r'\g<1>-{}'.format(n), line)
+            dump.append(line)
+    return dump
+
+
+def benchmark(name, lines, repeat):
+    result = xrandr_facts.parse_xrandr_verbose(lines)
+    connectors = sum(len(outputs) for outputs in result.values())
+    best = min(timeit.repeat(lambda: xrandr_facts.parse_xrandr_verbose(lines),
+                             number=1, repeat=repeat))
+    print("{}: {} lines, {} connectors: {:.4f} s ({:.0f} lines/s)".format(
+        name, len(lines), connectors, best, len(lines) / best))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time parse_xrandr_verbose on the test corpus")
+    parser.add_argument('dump', nargs='?', default=os.path.join(CORPUS_DIR, 'xrandr_output.8k'),
+                        help='dump used for the synthetic dump')
+    parser.add_argument('-c', '--copies', type=int, default=100,
+                        help='number of copies of the connectors of the dump')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of timed runs, the best one is reported')
+    args = parser.parse_args()
+
+    for name in sorted(os.listdir(CORPUS_DIR)):
+        if not name.endswith('.json'):
+            with open(os.path.join(CORPUS_DIR, name)) as f:
+                benchmark(name, f.readlines(), args.repeat)
+    with open(args.dump) as f:
+        lines = synthetic_dump(f.readlines(), args.copies)
+    benchmark('synthetic ({} x {})'.format(args.copies, os.path.basename(args.dump)), lines, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
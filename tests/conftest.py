@@ -0,0 +1,10 @@
+# make the modules in library/ and the module_utils of this repository importable for the tests,
+# ansible ships module_utils next to the playbooks as part of ansible.module_utils
+import os
+import sys
+
+import ansible.module_utils
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(REPO_DIR, 'library'))
+ansible.module_utils.__path__.append(os.path.join(REPO_DIR, 'module_utils'))
@@ -0,0 +1,80 @@
+# tests for the summary of roles/channellogos/templates/channel_linker.py.j2,
+# the task "update channel logo links" decides on changed by its last line
+import json
+import os
+import types
+
+import pytest
+
+pytest.importorskip('lxml')
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                        'roles', 'channellogos', 'templates', 'channel_linker.py.j2')
+
+MAPPING = '''<?xml version="1.0" encoding="utf-8"?>
+<Mappings>
+  <TV>
+    <Channel><File>Das Erste HD.png</File><Item Name="Das Erste HD"/><Item Name="ARD"/></Channel>
+  </TV>
+  <Radio>
+    <Channel><File>Bayern 3.png</File><Item Name="Bayern 3"/></Channel>
+  </Radio>
+</Mappings>
+'''
+
+
+@pytest.fixture
+def channel_linker(tmp_path):
+    """the script without the ansible_managed header, its paths point to tmp_path"""
+    with open(TEMPLATE) as f:
+        source = ''.join(line for line in f if '{{' not in line)
+    module = types.ModuleType('channel_linker')
+    exec(compile(source, TEMPLATE, 'exec'), module.__dict__)
+    repository = tmp_path / 'mediaportal-de-logos'
+    (repository / '.git').mkdir(parents=True)
+    (repository / '.git' / 'HEAD').write_text('0123456789abcdef0123456789abcdef01234567\n')
+    (repository / 'LogoMapping.xml').write_text(MAPPING)
+    module.target = tmp_path / 'channellogos'
+    module.index_file = tmp_path / 'channel_linker.json'
+    module.logo_repository = lambda language: tmp_path / f'mediaportal-{language}-logos'
+    return module
+
+
+def run(channel_linker, capsys, *argv):
+    changed = channel_linker.main(['--json', *argv])
+    summary = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert summary['changed'] == changed
+    return summary
+
+
+def test_summary(channel_linker, capsys):
+    summary = run(channel_linker, capsys, 'de')
+    assert summary == {'created': 3, 'retargeted': 0, 'removed': 0, 'unchanged': 0, 'changed': True}
+    assert sorted(os.listdir(channel_linker.target)) == ['ard.png', 'bayern 3.png', 'das erste hd.png']
+
+    summary = run(channel_linker, capsys, 'de')
+    assert summary == {'created': 0, 'retargeted': 0, 'removed': 0, 'unchanged': 3, 'changed': False}
+
+    (channel_linker.target / 'old.png').symlink_to('/nonexistent.png')
+    os.remove(channel_linker.target / 'ard.png')
+    os.symlink('/nonexistent.png', channel_linker.target / 'ard.png')
+    summary = run(channel_linker, capsys, 'de')
+    assert summary == {'created': 0, 'retargeted': 1, 'removed': 1, 'unchanged': 2, 'changed': True}
+
+
+def test_rebuild_is_a_change(channel_linker, capsys):
+    run(channel_linker, capsys, 'de')
+    summary = run(channel_linker, capsys, '--rebuild', 'de')
+    assert summary['created'] == 3
+    assert summary['changed']
+
+
+@pytest.mark.parametrize('argv', [(), ('xx',), ('--rebuild', 'xx')])
+def test_no_valid_language_is_no_change(channel_linker, capsys, argv):
+    assert run(channel_linker, capsys, *argv)['changed'] is False
+
+
+def test_text_summary(channel_linker, capsys):
+    assert channel_linker.main(['de'])
+    assert capsys.readouterr().out.splitlines()[-1] == (
+        'channel logos: 3 created, 0 retargeted, 0 removed, 0 unchanged')
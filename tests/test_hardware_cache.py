@@ -0,0 +1,25 @@
+# tests for the fact cache shared by hardware_facts and pci_facts
+from ansible.module_utils import hardware_cache
+
+
+def test_cache_is_keyed_on_params(tmp_path):
+    cache_file = str(tmp_path / 'facts.d' / 'pci_facts.cache')
+    facts = {'pci_devices': [{'slot': '00:02.0'}]}
+    hardware_cache.store_cache(cache_file, 'fingerprint', {'backend': 'lspci'}, facts)
+    assert hardware_cache.load_cache(cache_file, 'fingerprint', {'backend': 'lspci'}) == facts
+    assert hardware_cache.load_cache(cache_file, 'fingerprint', {'backend': 'sysfs'}) is None
+    assert hardware_cache.load_cache(cache_file, 'other fingerprint', {'backend': 'lspci'}) is None
+
+
+def test_missing_or_broken_cache(tmp_path):
+    cache_file = tmp_path / 'hardware_facts.cache'
+    assert hardware_cache.load_cache(str(cache_file), 'fingerprint', {}) is None
+    cache_file.write_text('{')
+    assert hardware_cache.load_cache(str(cache_file), 'fingerprint', {}) is None
+
+
+def test_modules_share_the_cache_helpers():
+    import hardware_facts
+    import pci_facts
+    assert hardware_facts.hardware_fingerprint is pci_facts.hardware_fingerprint
+    assert hardware_facts.load_cache is pci_facts.load_cache
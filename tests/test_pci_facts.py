@@ -0,0 +1,42 @@
+# compare the sysfs backend of library/pci_facts.py with the parsed output of lspci -nm
+import pci_facts
+
+# a fake /sys/bus/pci/devices with a second pci domain (e.g. behind an Intel VMD controller)
+# as (slot, class, vendor, device, subsystem vendor, subsystem device, revision)
+DEVICES = [
+    ('0000:00:02.0', 0x030000, 0x8086, 0x3e92, 0x1028, 0x085a, 0x02),
+    ('0000:00:0e.0', 0x010400, 0x8086, 0x467f, 0x0000, 0x0000, 0x00),
+    ('0000:00:1f.3', 0x040300, 0x8086, 0xa348, 0x1028, 0x0869, 0x10),
+    ('10000:e0:06.0', 0x060400, 0x8086, 0x464d, 0x0000, 0x0000, 0x05),
+    ('10000:e1:00.0', 0x010802, 0x144d, 0xa80a, 0x144d, 0xa801, 0x00),
+]
+
+# lspci -nm prints the domain only for the devices outside of domain 0000
+LSPCI_OUTPUT = '''\
+00:02.0 "0300" "8086" "3e92" -r02 "1028" "085a"
+00:0e.0 "0104" "8086" "467f" "" ""
+00:1f.3 "0403" "8086" "a348" -r10 "1028" "0869"
+10000:e0:06.0 "0604" "8086" "464d" -r05 "" ""
+10000:e1:00.0 "0108" "144d" "a80a" -p02 "144d" "a801"
+'''
+
+
+def make_pci_sysfs(sysfs):
+    for slot, pci_class, vendor, device, sub_vendor, sub_device, revision in DEVICES:
+        path = sysfs / slot
+        path.mkdir(parents=True)
+        for attribute, value, digits in (('class', pci_class, 6), ('vendor', vendor, 4), ('device', device, 4),
+                                         ('subsystem_vendor', sub_vendor, 4),
+                                         ('subsystem_device', sub_device, 4), ('revision', revision, 2)):
+            (path / attribute).write_text('0x{:0{}x}\n'.format(value, digits))
+
+
+def test_sysfs_matches_lspci(tmp_path, monkeypatch):
+    make_pci_sysfs(tmp_path)
+    monkeypatch.setattr(pci_facts, 'PCI_SYSFS', str(tmp_path))
+    expected = [pci_facts.parse_lspci_line(line) for line in LSPCI_OUTPUT.splitlines()]
+    assert pci_facts.read_sysfs_data() == expected
+    assert [device['slot'] for device in expected] == [
+        '00:02.0', '00:0e.0', '00:1f.3', '10000:e0:06.0', '10000:e1:00.0']
+    assert expected[3]['sub_vendor_id'] is None
+    assert expected[4]['progif'] == 0x02
@@ -0,0 +1,39 @@
+# tests for the SSDP discovery of library/satip_facts.py
+import pytest
+
+pytest.importorskip('requests')
+
+import satip_facts  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeSocket:
+    def __init__(self, clock):
+        self.clock = clock
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((self.clock.now, data, address))
+
+
+def test_latency_is_measured_from_the_last_request(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(satip_facts.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(satip_facts.time, 'sleep', clock.sleep)
+    sock = FakeSocket(clock)
+    sent = satip_facts.send_requests(sock)
+    assert len(sock.sent) == 3
+    assert all(address == (satip_facts.SSDP_ADDR, satip_facts.SSDP_PORT) for _, _, address in sock.sent)
+    # the three requests are sent within 100 ms
+    assert sock.sent[-1][0] - sock.sent[0][0] < 0.1
+    assert sent == sock.sent[-1][0]
@@ -0,0 +1,137 @@
+# tests for the builtin EDID decoder of library/xrandr_facts.py
+#
+# the EDIDs are taken from the xrandr dumps in tests/xrandr_facts, the expected
+# values have been decoded by hand from the raw bytes
+import json
+import os
+
+import pytest
+
+import xrandr_facts
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xrandr_facts')
+
+
+def sample_edid(dump, connector):
+    with open(os.path.join(CORPUS_DIR, dump + '.json')) as f:
+        return bytes.fromhex(json.load(f)['Screen 0:'][connector]['EDID'])
+
+
+# DELL 2407WFP, EDID 1.3 base block only
+DELL = sample_edid('xrandr_output.2', 'VGA-0')
+# ADI A715
+ADI = sample_edid('xrandr_output.2', 'HDMI-0')
+# SAMSUNG TV with a CTA-861 extension block
+SAMSUNG = sample_edid('xrandr_output.1', 'HDMI-0')
+
+
+def test_dtd_with_separate_sync_polarity():
+    # flags 0x1a: digital separate sync, +HSync, -VSync
+    dtd = bytes.fromhex('283c80a070b023403020360007442100001a')
+    assert xrandr_facts.decode_dtd(dtd) == (
+        'Modeline "1920x1200_60" 154.000 1920 1968 2000 2080 1200 1203 1209 1235 +HSync -VSync')
+    # flags 0x1e: digital separate sync, +HSync, +VSync
+    dtd = bytes.fromhex('302a009851002a4030701300520e1100001e')
+    assert xrandr_facts.decode_dtd(dtd) == (
+        'Modeline "1280x1024_60" 108.000 1280 1328 1440 1688 1024 1025 1028 1066 +HSync +VSync')
+
+
+def test_display_descriptor_is_not_a_mode():
+    # the range limits descriptor (tag 0xfd) of the DELL 2407WFP
+    assert xrandr_facts.decode_dtd(DELL[108:126]) is None
+
+
+def test_interlaced_dtd():
+    # 1080i: the vertical values describe a field of 540 lines, the name carries the frame rate
+    dtd = bytes.fromhex('011d8018711c1620582c250075f23100009e')
+    assert xrandr_facts.decode_dtd(dtd) == (
+        'Modeline "1920x1080_30i" 74.250 1920 2008 2052 2200 1080 1084 1094 1125 +HSync +VSync Interlace')
+
+
+def test_decode_edid():
+    assert xrandr_facts.decode_edid(DELL) == (
+        'DEL', 'DELL 2407WFP',
+        ['Modeline "1920x1200_60" 154.000 1920 1968 2000 2080 1200 1203 1209 1235 +HSync -VSync'])
+    assert xrandr_facts.decode_edid(ADI) == (
+        'ADI', 'ADI A715',
+        ['Modeline "1280x1024_60" 108.000 1280 1328 1440 1688 1024 1025 1028 1066 +HSync +VSync',
+         'Modeline "800x600_60" 40.000 800 840 968 1056 600 601 605 628 +HSync +VSync'])
+    vendor, model, modelines = xrandr_facts.decode_edid(SAMSUNG)
+    assert (vendor, model) == ('SAM', 'SAMSUNG')
+    # two detailed timings of the base block and four of the CTA-861 extension block
+    assert [m.split('"')[1] for m in modelines] == [
+        '1280x720_60', '1280x720_50', '1920x1080_30i', '1920x1080_25i', '720x480_60', '720x576_50']
+
+
+@pytest.mark.parametrize('edid', [b'', b'\x00' * 128, DELL[:127]])
+def test_decode_invalid_edid(edid):
+    assert xrandr_facts.decode_edid(edid) == ('Unknown', 'Unknown', [])
+    assert list(xrandr_facts.edid_timings(edid)) == []
+
+
+def test_established_and_standard_timings():
+    # established timings a5 4b 00, standard timings 8180 a940 714f b300
+    timings = [(t.resolution, t.refreshrate, t.interlaced) for t in xrandr_facts.vesa_timings(DELL)]
+    assert timings == [
+        ('720x400', 70, False), ('640x480', 60, False), ('640x480', 75, False), ('800x600', 60, False),
+        ('800x600', 75, False), ('1024x768', 60, False), ('1024x768', 75, False), ('1280x1024', 75, False),
+        ('1280x1024', 60, False), ('1600x1200', 60, False), ('1152x864', 75, False), ('1680x1050', 60, False),
+    ]
+
+
+def test_interlaced_established_timing():
+    edid = bytearray(DELL)
+    edid[35:38] = b'\x00\x10\x00'  # 1024x768@87 interlaced only
+    edid[38:54] = b'\x01\x01' * 8
+    assert list(xrandr_facts.vesa_timings(bytes(edid))) == [
+        xrandr_facts.Timing('1024x768', 87, True, None)]
+
+
+def test_cta_extension_block():
+    # video data block 46: 84 13 05 14 03 12, bit 7 of 0x84 marks VIC 4 as native
+    assert list(xrandr_facts.cta_video_codes(SAMSUNG)) == [4, 19, 5, 20, 3, 18]
+    assert list(xrandr_facts.cta_video_codes(DELL)) == []
+    timings = list(xrandr_facts.edid_timings(SAMSUNG))
+    # the detailed timings come first, the preferred one leads
+    assert timings[0] == xrandr_facts.Timing(
+        '1280x720', 60, False, '74.250 1280 1390 1430 1650 720 725 730 750 +HSync +VSync')
+    assert timings[2].interlaced
+    # the progressive VICs follow (the interlaced VICs 5 and 20 are unknown)
+    assert timings[6:10] == [xrandr_facts.CTA_VIDEO_FORMATS[vic] for vic in (4, 19, 3, 18)]
+    assert timings[10:] == [xrandr_facts.Timing('640x480', 60, False, None)]
+
+
+class FakeModule:
+    def __init__(self):
+        self.warnings = []
+
+    def warn(self, msg):
+        self.warnings.append(msg)
+
+
+def test_cross_check_warns_on_disagreement(monkeypatch):
+    fake_module = FakeModule()
+    monkeypatch.setattr(xrandr_facts, 'module', fake_module, raising=False)
+    vendor, model, modelines = xrandr_facts.decode_edid(DELL)
+
+    monkeypatch.setattr(xrandr_facts, 'run_edid_decode', lambda edid: (vendor, model, list(modelines)))
+    assert xrandr_facts.parse_edid_data(DELL, 'cross-check') == (vendor, model, modelines)
+    assert fake_module.warnings == []
+
+    # edid-decode misses the mode of the builtin decoder
+    monkeypatch.setattr(xrandr_facts, 'run_edid_decode', lambda edid: (vendor, model, []))
+    assert xrandr_facts.parse_edid_data(DELL, 'cross-check') == (vendor, model, modelines)
+    assert len(fake_module.warnings) == 1
+    assert 'edid-decode disagrees' in fake_module.warnings[0]
+
+    # or reports another model
+    monkeypatch.setattr(xrandr_facts, 'run_edid_decode', lambda edid: (vendor, 'Unknown', list(modelines)))
+    xrandr_facts.parse_edid_data(DELL, 'cross-check')
+    assert len(fake_module.warnings) == 2
+
+
+def test_builtin_parser_does_not_run_edid_decode(monkeypatch):
+    def fail(edid):
+        raise AssertionError('edid-decode called')
+    monkeypatch.setattr(xrandr_facts, 'run_edid_decode', fail)
+    assert xrandr_facts.parse_edid_data(DELL, 'builtin')[1] == 'DELL 2407WFP'
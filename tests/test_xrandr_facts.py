@@ -0,0 +1,270 @@
+# regression tests for the xrandr --verbose parser of library/xrandr_facts.py
+#
+# tests/xrandr_facts contains xrandr --verbose dumps and the expected result as <dump>.json:
+#   xrandr_output.1, xrandr_output.2 - captured dumps from Manual.org (nvidia), the results
+#       of the line-pulling parser which was used before the streaming parser, checked by hand
+#   xrandr_output.multi-gpu - intel (modesetting) with an amdgpu PRIME output sink,
+#       hand-built from CTA-861 and CVT-RB timings, the result was written by hand
+#   xrandr_output.mst - two DisplayPort MST displays behind DP-1, hand-built like multi-gpu
+#   xrandr_output.8k - an 8K TV with 236 modes, checked in test_8k_dump
+# Run with: python3 -m pytest tests
+import json
+import os
+
+import pytest
+
+import xrandr_facts
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xrandr_facts')
+CORPUS = sorted(f[:-len('.json')] for f in os.listdir(CORPUS_DIR) if f.endswith('.json'))
+
+
+def read_dump(name):
+    with open(os.path.join(CORPUS_DIR, name)) as f:
+        return f.readlines()
+
+
+def read_expected(name):
+    with open(os.path.join(CORPUS_DIR, name + '.json')) as f:
+        return json.load(f)
+
+
+def parse(lines):
+    # the expected results are stored as JSON
+    return json.loads(json.dumps(xrandr_facts.parse_xrandr_verbose(lines)))
+
+
+def is_subset(partial, full):
+    """check that every connector, mode and modeline of partial is part of full"""
+    for screen, outputs in partial.items():
+        for connector, data in outputs.items():
+            reference = full[screen][connector]
+            if not reference['EDID'].startswith(data['EDID']):
+                return False
+            for resolution, rrates in data['modes'].items():
+                if not set(rrates) <= set(reference['modes'][resolution]):
+                    return False
+            # a later mode with the same resolution and rounded refresh rate replaces
+            # the modeline, so only the names are compared
+            if not set(data['modelines']) <= set(reference['modelines']):
+                return False
+            for key in ('preferred', 'current'):
+                if data[key] not in ('', reference[key]):
+                    return False
+    return True
+
+
+@pytest.mark.parametrize('name', CORPUS)
+def test_corpus(name):
+    assert parse(read_dump(name)) == read_expected(name)
+
+
+@pytest.mark.parametrize('name', CORPUS)
+def test_accepts_a_line_iterator(name):
+    with open(os.path.join(CORPUS_DIR, name)) as f:
+        assert parse(f) == read_expected(name)
+
+
+def test_8k_dump():
+    outputs = parse(read_dump('xrandr_output.8k'))['Screen 0:']
+    assert sorted(outputs) == ['DisplayPort-0', 'HDMI-A-0', 'HDMI-A-1']
+    assert not outputs['HDMI-A-1']['is_connected']
+    tv = outputs['HDMI-A-0']
+    # 18 resolutions with 13 modes each (the NTSC variants round to the same refresh rate)
+    # and two interlaced modes which are skipped
+    assert len(tv['modes']) == 18
+    for resolution, rrates in tv['modes'].items():
+        assert rrates == [60, 50, 48, 30, 25, 24, 120, 100], resolution
+    assert len(tv['modelines']) == 18 * 8
+    assert tv['preferred'] == '7680x4320_60'
+    assert tv['current'] == '3840x2160_50'
+    # the 59.94 Hz mode follows the 60 Hz mode and replaces its modeline
+    assert tv['modelines']['7680x4320_60'] == (
+        'Modeline "7680x4320_60"  2373.626 7680 8232 8408 9000 4320 4336 4356 4400 +HSync +VSync')
+    assert tv['modelines']['7680x4320_50'] == (
+        'Modeline "7680x4320_50"  2376.000 7680 10032 10208 10800 4320 4336 4356 4400 +HSync +VSync')
+    assert len(tv['EDID']) == 256
+
+
+@pytest.mark.parametrize('name', CORPUS)
+def test_truncated_dumps(name):
+    # the previous parser raised StopIteration if the dump ended within an EDID block
+    # or a mode, a truncated dump must give a consistent part of the full result
+    lines = read_dump(name)
+    expected = read_expected(name)
+    for length in range(len(lines)):
+        assert is_subset(parse(lines[:length]), expected), length
+
+
+def test_truncated_mode_is_dropped():
+    lines = read_dump('xrandr_output.2')
+    # cut the dump after the h: line of the first mode of the connected output
+    cut = next(n for n, line in enumerate(lines) if line.strip().startswith('h:')) + 1
+    for outputs in parse(lines[:cut]).values():
+        for data in outputs.values():
+            assert data['modes'] == {}
+            assert data['modelines'] == {}
+
+
+def make_drm_connector(sysfs, name, status='disconnected', edid=b'', modes=()):
+    connector = sysfs / name
+    connector.mkdir(parents=True)
+    (connector / 'status').write_text(status + '\n')
+    (connector / 'enabled').write_text(('enabled' if status == 'connected' else 'disabled') + '\n')
+    (connector / 'edid').write_bytes(edid)
+    (connector / 'modes').write_text(''.join(mode + '\n' for mode in modes))
+    return connector
+
+
+def make_drm_card(sysfs, card, slot, driver):
+    """a drm card whose device links to a pci device bound to driver, like in /sys"""
+    sys_dir = sysfs.parent
+    device = sys_dir / 'devices' / 'pci0000:00' / slot
+    device.mkdir(parents=True)
+    for target in (sys_dir / 'bus' / 'pci', sys_dir / 'bus' / 'pci' / 'drivers' / driver):
+        target.mkdir(parents=True, exist_ok=True)
+    (device / 'subsystem').symlink_to(sys_dir / 'bus' / 'pci')
+    (device / 'driver').symlink_to(sys_dir / 'bus' / 'pci' / 'drivers' / driver)
+    (sysfs / card).mkdir(parents=True)
+    (sysfs / card / 'device').symlink_to(device)
+
+
+def corpus_edid(name, connector):
+    return bytes.fromhex(read_expected(name)['Screen 0:'][connector]['EDID'])
+
+
+@pytest.mark.parametrize('drm_connector, driver, name', [
+    ('HDMI-A-1', 'i915', 'HDMI-1'),
+    ('DP-2', 'i915', 'DP-2'),
+    ('eDP-1', None, 'eDP-1'),
+    ('HDMI-A-1', 'amdgpu', 'HDMI-A-0'),
+    ('DP-2', 'amdgpu', 'DisplayPort-1'),
+    ('DVI-D-1', 'radeon', 'DVI-D-0'),
+    ('SVIDEO-1', 'radeon', 'S-video-0'),
+    ('Virtual', 'qxl', 'Virtual'),
+])
+def test_xrandr_connector_name(drm_connector, driver, name):
+    assert xrandr_facts.xrandr_connector_name(drm_connector, driver) == name
+
+
+def test_read_drm_outputs(tmp_path, monkeypatch):
+    sysfs = tmp_path / 'class' / 'drm'
+    make_drm_card(sysfs, 'card0', '0000:00:02.0', 'i915')
+    make_drm_card(sysfs, 'card1', '0000:01:00.0', 'amdgpu')
+    make_drm_connector(sysfs, 'card0-HDMI-A-1', 'connected', corpus_edid('xrandr_output.1', 'HDMI-0'),
+                       ['1280x720', '1920x1080i', '720x576', '720x480', '640x480'])
+    make_drm_connector(sysfs, 'card0-DP-1')
+    make_drm_connector(sysfs, 'card1-HDMI-A-1', 'connected', corpus_edid('xrandr_output.2', 'VGA-0'),
+                       ['1920x1200', '1600x1200', '1680x1050'])
+    make_drm_connector(sysfs, 'card1-DP-1')
+    monkeypatch.setattr(xrandr_facts, 'DRM_SYSFS', str(sysfs))
+
+    connectors, by_edid = xrandr_facts.drm_connector_index()
+    assert connectors['card0-HDMI-A-1']['driver'] == 'i915'
+    assert connectors['card1-DP-1']['device'] == '0000:01:00.0'
+    assert connectors['card1-DP-1']['subsystem'] == 'pci'
+    assert sorted(names for names in by_edid.values()) == [['card0-HDMI-A-1'], ['card1-HDMI-A-1']]
+
+    outputs = xrandr_facts.read_drm_outputs()['Screen 0:']
+    # modesetting names on the intel card, amdgpu names counting from 0 on the second card
+    assert sorted(outputs) == ['DP-1', 'DisplayPort-0', 'HDMI-1', 'HDMI-A-0']
+    assert not outputs['DP-1']['is_connected']
+    assert not outputs['DisplayPort-0']['is_connected']
+    tv = outputs['HDMI-1']
+    assert tv['enabled']
+    assert tv['EDID'] == corpus_edid('xrandr_output.1', 'HDMI-0').hex()
+    # the interlaced 1080i timings and the modes the kernel doesn't list are left out
+    assert tv['modes'] == {'1280x720': [60, 50], '720x480': [60], '720x576': [50], '640x480': [60]}
+    assert tv['preferred'] == '1280x720_60'
+    assert tv['modelines']['1280x720_60'] == (
+        'Modeline "1280x720_60"  74.250 1280 1390 1430 1650 720 725 730 750 +HSync +VSync')
+    # the established timings have no modeline
+    assert '640x480_60' not in tv['modelines']
+    monitor = outputs['HDMI-A-0']
+    assert monitor['modes'] == {'1920x1200': [60], '1600x1200': [60], '1680x1050': [60]}
+    assert monitor['preferred'] == '1920x1200_60'
+
+
+def test_read_drm_outputs_renames_duplicates(tmp_path, monkeypatch):
+    sysfs = tmp_path / 'class' / 'drm'
+    make_drm_card(sysfs, 'card0', '0000:00:02.0', 'i915')
+    make_drm_card(sysfs, 'card1', '0000:01:00.0', 'nouveau')
+    make_drm_connector(sysfs, 'card0-HDMI-A-1', 'connected', corpus_edid('xrandr_output.1', 'HDMI-0'))
+    make_drm_connector(sysfs, 'card1-HDMI-A-1', 'connected', corpus_edid('xrandr_output.2', 'HDMI-0'))
+    make_drm_connector(sysfs, 'card1-DP-1')
+    monkeypatch.setattr(xrandr_facts, 'DRM_SYSFS', str(sysfs))
+
+    outputs = xrandr_facts.read_drm_outputs()['Screen 0:']
+    # both cards use the modesetting names, the connector of card1 gets the card number
+    assert sorted(outputs) == ['DP-1', 'HDMI-1', 'HDMI-1-1']
+    assert outputs['HDMI-1']['EDID'] == corpus_edid('xrandr_output.1', 'HDMI-0').hex()
+    assert outputs['HDMI-1-1']['EDID'] == corpus_edid('xrandr_output.2', 'HDMI-0').hex()
+    # without a modes file the first EDID timing is the preferred mode
+    assert outputs['HDMI-1-1']['preferred'] == '1280x1024_60'
+
+
+def test_read_drm_outputs_without_displays(tmp_path, monkeypatch):
+    sysfs = tmp_path / 'class' / 'drm'
+    make_drm_card(sysfs, 'card0', '0000:00:02.0', 'i915')
+    make_drm_connector(sysfs, 'card0-HDMI-A-1')
+    monkeypatch.setattr(xrandr_facts, 'DRM_SYSFS', str(sysfs))
+    assert xrandr_facts.read_drm_outputs() == {}
+
+
+PROFILE_PARAMS = {
+    'preferred_outputs': [],
+    'preferred_refreshrates': [50, 60],
+    'preferred_resolutions': ['1920x1080'],
+    'backend': 'drm',
+    'edid_parser': 'builtin',
+}
+
+
+def test_display_profile_lookup(tmp_path, monkeypatch):
+    sysfs = tmp_path / 'drm'
+    edid = bytes.fromhex(read_expected('xrandr_output.2')['Screen 0:']['HDMI-0']['EDID'])
+    make_drm_connector(sysfs, 'card0-HDMI-A-1', 'connected', edid)
+    make_drm_connector(sysfs, 'card0-DP-1')
+    monkeypatch.setattr(xrandr_facts, 'DRM_SYSFS', str(sysfs))
+    cache_file = str(tmp_path / 'facts.d' / 'xrandr_facts.cache')
+    facts = {'xorg': {'primary': {'connector': 'HDMI-1'}}}
+
+    # the profile stored by the detecting task is found by a lookup with the same params
+    xrandr_facts.store_display_profile(cache_file, xrandr_facts.display_profile_key(dict(PROFILE_PARAMS)), facts)
+    profiles = xrandr_facts.load_display_profiles(cache_file)
+    assert profiles.get(xrandr_facts.display_profile_key(dict(PROFILE_PARAMS))) == facts
+
+    # other params don't hit the profile
+    for param, value in (('backend', 'xrandr'), ('edid_parser', 'cross-check'), ('preferred_refreshrates', [60])):
+        assert xrandr_facts.display_profile_key(dict(PROFILE_PARAMS, **{param: value})) not in profiles
+
+    # neither do other displays
+    make_drm_connector(sysfs, 'card1-HDMI-A-1', 'connected', b'\x00\xff\xff\xff\xff\xff\xff\x00')
+    assert xrandr_facts.display_profile_key(dict(PROFILE_PARAMS)) not in profiles
+
+
+def test_nvidia_gpus_cache(tmp_path, monkeypatch):
+    cache_file = str(tmp_path / 'facts.d' / 'xrandr_facts.gpus.cache')
+    gpu = {'name': 'GeForce GT 1030', 'slot': '0000:01:00.0', 'bus_id': 'PCI:1@0:0:0'}
+    calls = []
+
+    def find_nvidia_gpus():
+        calls.append(1)
+        return [gpu], True
+    monkeypatch.setattr(xrandr_facts, 'find_nvidia_gpus', find_nvidia_gpus)
+    monkeypatch.setattr(xrandr_facts, 'boot_id', lambda: 'boot-1')
+
+    # the GPUs are looked up once per boot
+    assert xrandr_facts.nvidia_gpus(cache_file) == [gpu]
+    assert xrandr_facts.nvidia_gpus(cache_file) == [gpu]
+    assert len(calls) == 1
+    monkeypatch.setattr(xrandr_facts, 'boot_id', lambda: 'boot-2')
+    assert xrandr_facts.nvidia_gpus(cache_file) == [gpu]
+    assert len(calls) == 2
+
+    # an incomplete result (e.g. while nouveau is loaded) isn't kept
+    monkeypatch.setattr(xrandr_facts, 'find_nvidia_gpus', lambda: ([], False))
+    monkeypatch.setattr(xrandr_facts, 'boot_id', lambda: 'boot-3')
+    assert xrandr_facts.nvidia_gpus(cache_file) == []
+    with open(cache_file) as f:
+        assert json.load(f)['boot_id'] == 'boot-2'